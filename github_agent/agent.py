@@ -1,19 +1,31 @@
 from __future__ import annotations
 
 import asyncio
+import copy
 import json
+import logging
+import math
 import os
+import re
+import sys
+import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import Any, Dict, List, Optional, TypedDict, cast
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypedDict, cast
 
 import yaml
 from dotenv import load_dotenv
 from langchain_core.messages import HumanMessage, SystemMessage
-from langchain_openai import ChatOpenAI
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langgraph.graph import END, StateGraph
 from mcp.client.session import ClientSession
 from mcp.client.stdio import StdioServerParameters, stdio_client
 
+try:
+    import orjson
+except ImportError:  # optional speedup
+    orjson = None
+
 # ============================================================
 # Load configuration and secrets
 # ============================================================
@@ -31,8 +43,30 @@ if not OPENAI_API_KEY:
 with open(BASE_DIR / "config.yaml", "r", encoding="utf-8") as f:
     CONFIG = yaml.safe_load(f)
 
+LOGGER = logging.getLogger("github_agent")
+
+
+def _json_loads(data: str | bytes) -> Any:
+    """
+    Parse JSON, using orjson when available (tool payloads can be large).
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj: Any) -> str:
+    """
+    Serialize to compact JSON text, using orjson when available.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, separators=(",", ":"))
+
+
 LLM_CFG = CONFIG["llm"]
 MCP_CFG = CONFIG["mcp"]
+CACHE_CFG = CONFIG.get("cache", {}) or {}
 
 # ============================================================
 # Agent state
@@ -48,32 +82,264 @@ class AgentState(TypedDict):
     tool_calls: Optional[List[Dict[str, Any]]]  # Planned tool calls
     tool_results: Optional[List[Dict[str, Any]]]  # Results per tool call
     final_answer: Optional[str]
+    stream: Optional[bool]  # Write the answer to stdout as it is generated (CLI)
+    on_token: Optional[Callable[[str], None]]  # Receives answer text as it is generated (UI)
+    prefetch: Optional[Dict[str, Any]]  # Tool calls started while the plan was still streaming
 
 # ============================================================
 # LLM initialization
 # ============================================================
 
-llm = ChatOpenAI(
+# The planner only emits a small JSON plan, so it gets a tighter token budget
+# (and JSON mode, on models that support it) than the answer synthesizer.
+PLANNER_JSON_MODE = bool(LLM_CFG.get("planner_json_mode", False))
+
+# Optional OpenAI prompt_cache_key: requests sharing a key are routed to the
+# same prompt cache, so the static system prefixes hit more often.
+PROMPT_CACHE_KEY = LLM_CFG.get("prompt_cache_key") or ""
+
+
+def _cache_kwargs(role: str) -> Dict[str, Any]:
+    return {"prompt_cache_key": f"{PROMPT_CACHE_KEY}-{role}"} if PROMPT_CACHE_KEY else {}
+
+
+llm_planner = ChatOpenAI(
+    api_key=OPENAI_API_KEY,
+    model=LLM_CFG.get("model", "gpt-4"),
+    temperature=LLM_CFG.get("temperature", 0),
+    max_tokens=LLM_CFG.get("planner_max_tokens", 256),
+    model_kwargs={
+        **({"response_format": {"type": "json_object"}} if PLANNER_JSON_MODE else {}),
+        **_cache_kwargs("planner"),
+    },
+)
+
+llm_synth = ChatOpenAI(
     api_key=OPENAI_API_KEY,
     model=LLM_CFG.get("model", "gpt-4"),
     temperature=LLM_CFG.get("temperature", 0),
     max_tokens=LLM_CFG.get("max_tokens", 1024),
+    model_kwargs=_cache_kwargs("synth"),
 )
 
+# ============================================================
+# Semantic plan cache
+# ============================================================
+
+# (normalized question, username, last_repo_user, last_repo) -> {"embedding", "plan"}.
+# Plans are stored before user/pronoun normalization, which is re-run on a hit.
+_PLAN_CACHE: "OrderedDict[Tuple[str, str, str, str], Dict[str, Any]]" = OrderedDict()
+_EMBEDDINGS: Optional[OpenAIEmbeddings] = None
+
+
+def _plan_cache_key(question: str, username: str, last_repo_user: Optional[str], last_repo: Optional[str]):
+    normalized = " ".join(question.lower().split()).rstrip("?.! ")
+    return (normalized, username or "", last_repo_user or "", last_repo or "")
+
+
+async def _embed(text: str) -> Optional[List[float]]:
+    """
+    L2-normalized embedding of `text`, or None if embeddings are unavailable.
+    """
+    global _EMBEDDINGS
+    if _EMBEDDINGS is None:
+        _EMBEDDINGS = OpenAIEmbeddings(
+            api_key=OPENAI_API_KEY,
+            model=CACHE_CFG.get("embedding_model", "text-embedding-3-small"),
+        )
+    try:
+        vec = await _EMBEDDINGS.aembed_query(text)
+    except Exception:
+        return None
+    norm = math.sqrt(sum(x * x for x in vec)) or 1.0
+    return [x / norm for x in vec]
+
+
+async def _lookup_plan(key) -> Tuple[Optional[Dict[str, Any]], Optional[List[float]]]:
+    """
+    Return (cached plan or None, question embedding). Exact repeats are served
+    without an embedding call; near-duplicates need cosine similarity above
+    the configured threshold, the same user/last-repo context, and every
+    concrete tool arg of the cached plan to appear in the new question.
+    """
+    entry = _PLAN_CACHE.get(key)
+    if entry is not None:
+        _PLAN_CACHE.move_to_end(key)
+        return copy.deepcopy(entry["plan"]), entry["embedding"]
+
+    emb = await _embed(key[0])
+    if emb is None:
+        return None, None
+
+    threshold = float(CACHE_CFG.get("plan_cache_threshold", 0.92))
+    best_key, best_score = None, threshold
+    for k, e in _PLAN_CACHE.items():
+        if k[1:] != key[1:] or e["embedding"] is None:
+            continue
+        if not _args_in_question(e["plan"], key):
+            # "tech stack of foo-api" vs "of bar-web" embed as near-duplicates
+            # but must not share a plan; those go through the templates.
+            continue
+        score = sum(a * b for a, b in zip(emb, e["embedding"]))
+        if score >= best_score:
+            best_key, best_score = k, score
+    if best_key is None:
+        return None, emb
+    _PLAN_CACHE.move_to_end(best_key)
+    return copy.deepcopy(_PLAN_CACHE[best_key]["plan"]), emb
+
+
+def _args_in_question(plan: Dict[str, Any], key) -> bool:
+    question, context = key[0], {v for v in key[1:] if v}
+    for c in plan.get("tool_calls") or []:
+        args = c.get("tool_args") or {}
+        if not isinstance(args, dict):
+            return False
+        for v in args.values():
+            if not isinstance(v, str) or v.startswith("$") or v in context:
+                continue
+            if v.lower() not in question:
+                return False
+    return True
+
+
+def _store_plan(key, embedding: Optional[List[float]], plan: Dict[str, Any]) -> None:
+    _PLAN_CACHE[key] = {"embedding": embedding, "plan": copy.deepcopy(plan)}
+    _PLAN_CACHE.move_to_end(key)
+    while len(_PLAN_CACHE) > int(CACHE_CFG.get("plan_cache_size", 512)):
+        _PLAN_CACHE.popitem(last=False)
+
+# Plan templates: tool_calls skeletons with concrete values replaced by slots,
+# so one planned question shape serves other users/repos. A slot is filled
+# either from the question (matched against the stored question pattern) or
+# from the current context ({USER}, {LAST_REPO}, {LAST_REPO_USER}).
+_PLAN_TEMPLATES: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_SLOT_TOKEN_RE = re.compile(r"([\w.-]+)")
+
+
+def _template_question(question: str) -> str:
+    return " ".join(question.split()).rstrip("?.! ")
+
+
+def _store_template(
+    question: str,
+    embedding: Optional[List[float]],
+    plan: Dict[str, Any],
+    username: str,
+    last_repo: Optional[str],
+    last_repo_user: Optional[str],
+) -> None:
+    if embedding is None or plan.get("type") != "tool_plan" or not plan.get("tool_calls"):
+        return
+
+    q = _template_question(question)
+    tokens = {t.lower() for t in _SLOT_TOKEN_RE.findall(q)}
+    slots: Dict[str, str] = {}  # lowercased question token -> slot name
+    context = {"USER": username, "LAST_REPO": last_repo, "LAST_REPO_USER": last_repo_user}
+    skeleton: List[Dict[str, Any]] = []
+    for c in plan["tool_calls"]:
+        args = c.get("tool_args") or {}
+        if not isinstance(args, dict):
+            return
+        t_args: Dict[str, Any] = {}
+        for k, v in args.items():
+            if isinstance(v, str) and not v.startswith("$"):
+                if v.lower() in tokens:
+                    v = "{%s}" % slots.setdefault(v.lower(), f"S{len(slots)}")
+                else:
+                    v = next(("{%s}" % name for name, cv in context.items() if cv and v == cv), v)
+            t_args[k] = v
+        skeleton.append({**c, "tool_args": t_args})
+
+    # Question pattern: literal text, with the slotted tokens as capture groups.
+    seen: set[str] = set()
+    pattern_parts: List[str] = []
+    for i, part in enumerate(_SLOT_TOKEN_RE.split(q)):
+        slot = slots.get(part.lower()) if i % 2 else None
+        if slot is None:
+            pattern_parts.append(re.escape(part).replace("\\ ", r"\s+"))
+        elif slot in seen:
+            pattern_parts.append(f"(?P={slot})")
+        else:
+            seen.add(slot)
+            pattern_parts.append(f"(?P<{slot}>[\\w.-]+)")
+    pattern = "".join(pattern_parts)
+
+    _PLAN_TEMPLATES[pattern] = {
+        "embedding": embedding,
+        "regex": re.compile(pattern, re.IGNORECASE),
+        "tool_calls": skeleton,
+    }
+    _PLAN_TEMPLATES.move_to_end(pattern)
+    while len(_PLAN_TEMPLATES) > int(CACHE_CFG.get("plan_cache_size", 512)):
+        _PLAN_TEMPLATES.popitem(last=False)
+
+
+def _hydrate(skeleton: List[Dict[str, Any]], values: Dict[str, Optional[str]]) -> Optional[List[Dict[str, Any]]]:
+    """
+    Fill "{SLOT}" args; None if a slot has no value in the current context.
+    """
+    tool_calls: List[Dict[str, Any]] = []
+    for c in skeleton:
+        args: Dict[str, Any] = {}
+        for k, v in c["tool_args"].items():
+            if isinstance(v, str) and v.startswith("{") and v.endswith("}") and v[1:-1] in values:
+                v = values[v[1:-1]]
+                if not v:
+                    return None
+            args[k] = v
+        tool_calls.append({**c, "tool_args": args})
+    return tool_calls
+
+
+def _match_template(
+    question: str,
+    embedding: List[float],
+    username: str,
+    last_repo: Optional[str],
+    last_repo_user: Optional[str],
+) -> Optional[Dict[str, Any]]:
+    """
+    Re-hydrate the most similar template whose question pattern matches.
+    """
+    threshold = float(CACHE_CFG.get("template_threshold", 0.90))
+    candidates = []
+    for pattern, t in _PLAN_TEMPLATES.items():
+        score = sum(a * b for a, b in zip(embedding, t["embedding"]))
+        if score >= threshold:
+            candidates.append((score, pattern))
+
+    q = _template_question(question)
+    for _, pattern in sorted(candidates, reverse=True):
+        t = _PLAN_TEMPLATES[pattern]
+        m = t["regex"].fullmatch(q)
+        if not m:
+            continue
+        values = {"USER": username, "LAST_REPO": last_repo, "LAST_REPO_USER": last_repo_user, **m.groupdict()}
+        tool_calls = _hydrate(t["tool_calls"], values)
+        if tool_calls is not None:
+            _PLAN_TEMPLATES.move_to_end(pattern)
+            return {"type": "tool_plan", "tool_calls": tool_calls}
+    return None
+
 # ============================================================
 # MCP client helper + tool catalog caching
 # ============================================================
 
-_TOOL_CATALOG: Optional[List[Dict[str, Any]]] = None
+_SERVER_PARAMS: Optional[StdioServerParameters] = None
 
 
 def _resolve_server_params() -> StdioServerParameters:
     """
-    Resolve server command paths relative to this file directory.
-    MCP_CFG["server_command"] is expected like:
+    Resolve server command paths relative to this file directory, once per
+    process. MCP_CFG["server_command"] is expected like:
       ["python", "../github_mcp/server.py", ...]
     """
-    server_cmd = MCP_CFG["server_command"].copy()
+    global _SERVER_PARAMS
+    if _SERVER_PARAMS is not None:
+        return _SERVER_PARAMS
+
+    server_cmd = MCP_CFG["server_command"]
     resolved_args: list[str] = []
     for arg in server_cmd[1:]:
         if arg and not os.path.isabs(arg):
@@ -82,48 +348,109 @@ def _resolve_server_params() -> StdioServerParameters:
         else:
             resolved_args.append(arg)
 
-    return StdioServerParameters(command=server_cmd[0], args=resolved_args)
-
-
-async def _with_mcp_session(fn):
-    server = _resolve_server_params()
-    async with stdio_client(server) as (read, write):
-        async with ClientSession(read, write) as session:
-            await session.initialize()
-            return await fn(session)
+    _SERVER_PARAMS = StdioServerParameters(command=server_cmd[0], args=resolved_args)
+    return _SERVER_PARAMS
 
 
-async def get_tool_catalog() -> List[Dict[str, Any]]:
+class McpClient:
     """
-    Cache the MCP tool catalog (names + inputSchema).
+    One long-lived MCP session per event loop, reused by every tool call
+    instead of spawning the server subprocess and re-running the handshake
+    per call. The tool catalog is fetched once per process.
+
+    The stdio/session contexts are owned by one background task, since anyio
+    requires them to be entered and exited from the same task.
     """
-    global _TOOL_CATALOG
-    if _TOOL_CATALOG is not None:
-        return _TOOL_CATALOG
 
-    async def _fetch(session: ClientSession):
-        tools = await session.list_tools()
-        out: List[Dict[str, Any]] = []
-        for t in tools.tools:
-            out.append(
+    _instance: Optional["McpClient"] = None
+
+    def __init__(self) -> None:
+        self._session: Optional[ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._tools_cache: Optional[List[Dict[str, Any]]] = None
+
+    @classmethod
+    def instance(cls) -> "McpClient":
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    async def _run(self, ready: asyncio.Future, stop: asyncio.Event) -> None:
+        try:
+            async with stdio_client(_resolve_server_params()) as (read, write):
+                async with ClientSession(read, write) as session:
+                    await session.initialize()
+                    ready.set_result(session)
+                    await stop.wait()
+        except BaseException as e:
+            if not ready.done():
+                ready.set_exception(e)
+            raise
+
+    async def ensure(self) -> ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # A previous event loop (e.g. an earlier asyncio.run) owned the old
+            # session; it was cancelled when that loop shut down.
+            self._session = self._task = self._stop = None
+            self._lock = asyncio.Lock()
+            self._loop = loop
+
+        async with self._lock:
+            if self._session is None or self._task is None or self._task.done():
+                ready: asyncio.Future = loop.create_future()
+                self._stop = asyncio.Event()
+                self._task = asyncio.create_task(self._run(ready, self._stop))
+                self._session = await ready
+            return self._session
+
+    async def tools(self) -> List[Dict[str, Any]]:
+        """
+        Cached MCP tool catalog (names + inputSchema).
+        """
+        if self._tools_cache is None:
+            session = await self.ensure()
+            tools = await session.list_tools()
+            self._tools_cache = [
                 {
                     "name": getattr(t, "name", ""),
                     "description": getattr(t, "description", "") or "",
                     "inputSchema": getattr(t, "inputSchema", {}) or {},
                 }
-            )
-        return out
+                for t in tools.tools
+            ]
+        return self._tools_cache
+
+    async def call_tool(self, tool: str, args: dict) -> Any:
+        session = await self.ensure()
+        return (await session.call_tool(tool, args)).content
+
+    async def close(self) -> None:
+        """
+        Close the session (and its server subprocess).
+        """
+        if self._task is not None and self._stop is not None:
+            self._stop.set()
+            try:
+                await self._task
+            except Exception:
+                pass
+        self._session = self._task = self._stop = None
 
-    _TOOL_CATALOG = await _with_mcp_session(_fetch)
-    return _TOOL_CATALOG
 
+async def shutdown() -> None:
+    await McpClient.instance().close()
 
-async def call_mcp_tool(tool: str, args: dict) -> Any:
-    async def _call(session: ClientSession):
-        result = await session.call_tool(tool, args)
-        return result.content
 
-    return await _with_mcp_session(_call)
+async def get_tool_catalog() -> List[Dict[str, Any]]:
+    return await McpClient.instance().tools()
+
+
+async def call_mcp_tool(tool: str, args: dict) -> Any:
+    return await McpClient.instance().call_tool(tool, args)
 
 
 def unwrap_mcp_content(content: Any) -> Any:
@@ -137,9 +464,16 @@ def unwrap_mcp_content(content: Any) -> Any:
     if isinstance(content, list):
         return [unwrap_mcp_content(c) for c in content]
 
-    # TextContent
+    # TextContent: tools return JSON, so parse it once here rather than
+    # passing strings downstream to be re-parsed / re-encoded.
     if hasattr(content, "text"):
-        return getattr(content, "text")
+        text = getattr(content, "text")
+        if isinstance(text, str) and text[:1] in ("{", "["):
+            try:
+                return _json_loads(text)
+            except json.JSONDecodeError:
+                pass
+        return text
 
     # JsonContent
     if hasattr(content, "json"):
@@ -164,29 +498,281 @@ def make_json_safe(obj: Any) -> Any:
         return [make_json_safe(x) for x in obj]
     return str(obj)
 
+# ============================================================
+# Static prompts
+# ============================================================
+
+# Kept as module constants and always sent first so every turn starts with the
+# same bytes, which lets the provider's prompt prefix cache reuse them.
+PLANNER_SYSTEM_STATIC = (
+    "You are a semantic planner for a GitHub analysis assistant.\n"
+    "You MUST output a single JSON object only.\n\n"
+    "Your job:\n"
+    "- Decide whether the user needs tool calls.\n"
+    "- If so, select the best tool(s) from the provided catalog.\n"
+    "- Support multi-step plans when required (e.g., 'tech stack of latest project' needs list_repos then get_repo_overview).\n\n"
+    "Planning constraints:\n"
+    "- Prefer multi-repo tools for questions across repositories (e.g., 'any repo with CI/CD', 'which repos use Python').\n"
+    "- Prefer single-repo tools only when the question is explicitly about one repo or a pronoun refers to last repo.\n"
+    "- Pronouns ('this project', 'that repo', 'it') may refer to the last discussed repo, if one is given.\n"
+    "- If the question is ambiguous and cannot be answered safely, propose a short clarification_question.\n"
+    "- If you need a tool's full input schema, reply with {\"needs_schema\": \"<tool_name>\"} instead of a plan.\n\n"
+    "Output JSON schema:\n"
+    "{\n"
+    '  "type": "direct_answer" | "tool_plan" | "clarify",\n'
+    '  "answer": string (only for direct_answer),\n'
+    '  "clarification_question": string (only for clarify),\n'
+    '  "tool_calls": [\n'
+    "     {\"tool_name\": string, \"tool_args\": object, \"save_as\": string (optional)}\n"
+    "  ]\n"
+    "}\n"
+)
+
+SYNTH_SYSTEM_STATIC = (
+    "You are a GitHub analysis assistant. You MUST answer using ONLY the provided tool outputs.\n\n"
+    "Rules:\n"
+    "- If the question is about tech stack, prioritize detected tech stack fields (e.g., signals.tech_stack) over repo.language.\n"
+    "- For multi-repo questions (CI/CD, tests, Docker, language usage), summarize across repositories using the multi-repo tool results.\n"
+    "- If the tool output lacks a detail, explicitly say it is not available.\n"
+    "- Do not hallucinate frameworks/tools that are not in tool outputs.\n"
+)
+
+SYNTH_SYSTEM = SystemMessage(content=SYNTH_SYSTEM_STATIC)
+
+# Fixed follow-up messages, shared rather than rebuilt per call.
+PLANNER_RETRY = HumanMessage(content="Return ONLY valid JSON matching the required schema. No text.")
+SUMMARIZE_SYSTEM = SystemMessage(
+    content=(
+        "Summarize these prior conversation turns in at most 200 tokens. "
+        "Preserve every GitHub user and repository mentioned."
+    )
+)
+
+_JSON_TYPES = {
+    "string": "str",
+    "integer": "int",
+    "number": "float",
+    "boolean": "bool",
+    "array": "list",
+    "object": "dict",
+}
+
+
+def _schema_type(prop: Dict[str, Any]) -> str:
+    if "anyOf" in prop:
+        return "|".join(_schema_type(p) for p in prop["anyOf"] if p.get("type") != "null") or "any"
+    return _JSON_TYPES.get(prop.get("type", ""), "any")
+
+
+def _first_sentence(text: str) -> str:
+    text = " ".join((text or "").strip().split("\n\n")[0].split())
+    head, sep, _ = text.partition(". ")
+    return head + ("." if sep else "")
+
+
+def _format_tool_brief(tools: List[Dict[str, Any]]) -> str:
+    """
+    One line per tool, e.g. `get_commit_timeline(user:str, repo:str, limit:int[opt]) — Return commit timeline.`
+    Much smaller than the JSON schemas it is derived from.
+    """
+    lines: List[str] = []
+    for t in tools:
+        schema = t.get("inputSchema") or {}
+        required = set(schema.get("required") or [])
+        args = ", ".join(
+            f"{name}:{_schema_type(prop)}{'' if name in required else '[opt]'}"
+            for name, prop in (schema.get("properties") or {}).items()
+        )
+        lines.append(f"{t.get('name')}({args}) — {_first_sentence(t.get('description', ''))}")
+    return "\n".join(lines)
+
+
+# Planner system message (static text + compact tool catalog), built once per
+# catalog object (the MCP client caches the catalog for the process).
+_PLANNER_SYSTEM: Optional[Tuple[int, SystemMessage]] = None
+
+
+def _planner_system(tools: List[Dict[str, Any]]) -> SystemMessage:
+    global _PLANNER_SYSTEM
+    if _PLANNER_SYSTEM is None or _PLANNER_SYSTEM[0] != id(tools):
+        _PLANNER_SYSTEM = (
+            id(tools),
+            SystemMessage(content=f"{PLANNER_SYSTEM_STATIC}\nTool catalog:\n{_format_tool_brief(tools)}\n"),
+        )
+    return _PLANNER_SYSTEM[1]
+
 # ============================================================
 # Semantic planning (intent reasoning)
 # ============================================================
 
+# A bare greeting, or "hi"/"hello"/"hey" followed by anything.
+_GREETING_RE = re.compile(r"(?:hii|yo|(?:hi|hello|hey)(?:\s.*)?)", re.IGNORECASE | re.DOTALL)
+
+# Tools scoped to one repo; they default to (and update) the last discussed repo.
+_SINGLE_REPO_TOOLS = frozenset({"get_repo_overview", "get_commit_timeline", "get_repo_signals"})
+
+
 def _looks_like_greeting(q: str) -> bool:
-    ql = (q or "").strip().lower()
-    return ql in {"hi", "hello", "hey", "hii", "yo"} or ql.startswith(("hi ", "hello ", "hey "))
+    return _GREETING_RE.fullmatch((q or "").strip()) is not None
+
+
+# Deterministic question shapes answered without the planner LLM. Anything
+# that does not match exactly falls through to the LLM.
+_LIST_REPOS_RE = re.compile(
+    r"^(?:list|show)(?:\s+me)?\s+(?:all\s+)?(?:my\s+)?repos?(?:itories)?"
+    r"(?:\s+(?:of|for|by)\s+@?(?P<user>[\w-]+))?$",
+    re.IGNORECASE,
+)
+_OVERVIEW_RE = re.compile(
+    r"^(?:overview\s+(?:of\s+)?|describe\s+|tell\s+me\s+about\s+)(?P<repo>[\w.-]+)$",
+    re.IGNORECASE,
+)
+_COMMITS_RE = re.compile(
+    r"^(?:show\s+)?(?:recent\s+)?(?:commits|commit\s+history)\s+(?:of|for|in)\s+(?P<repo>[\w.-]+)$",
+    re.IGNORECASE,
+)
+_PRONOUNS = frozenset({"it", "this", "that"})
+
+# Follow-ups about the last discussed repo ("what's the tech stack of this
+# project?"), routed by topic when exactly one topic matches.
+_FOLLOWUP_REF_RE = re.compile(r"\b(?:(?:this|that|the\s+same)\s+(?:project|repo(?:sitory)?)|its)\b", re.IGNORECASE)
+# Questions about more than the last repo (comparisons, sets of repos) need
+# the planner even when they mention "this project".
+_MULTI_REPO_RE = re.compile(
+    r"\b(?:others?|any|all|every|my\s+repos|repos|repositories|compare[sd]?|comparison|than|with|vs|versus|which|between|both)\b",
+    re.IGNORECASE,
+)
+# Words asking for a listing, which a follow-up overview must not replace.
+_LISTING_RE = re.compile(r"\b(?:list|all|repos|repositories|others?|similar|besides)\b", re.IGNORECASE)
+# Repo-like names (foo-api, owner/repo); "ci/cd" is a topic, not a repo.
+_REPO_NAME_RE = re.compile(r"(?<![\w./-])(?!ci/cd\b)[\w.]+(?:[-_/][\w.]+)+", re.IGNORECASE)
+
+
+def _names_other_repo(question: str, last_repo: str, last_repo_user: str) -> bool:
+    own = {last_repo.lower(), f"{last_repo_user}/{last_repo}".lower()}
+    return any(name.lower() not in own for name in _REPO_NAME_RE.findall(question))
+
+
+_FOLLOWUP_ROUTES = (
+    (
+        re.compile(
+            r"tech\s*stack|framework|librar|readme|description|docker|ci/cd|github\s+actions|\bstars\b|\bforks\b|\btests?\b",
+            re.IGNORECASE,
+        ),
+        "get_repo_overview",
+    ),
+    (re.compile(r"commit|timeline|history|activity", re.IGNORECASE), "get_commit_timeline"),
+)
+
+
+def _rule_plan(
+    question: str, last_repo: Optional[str], last_repo_user: Optional[str]
+) -> Optional[Dict[str, Any]]:
+    """
+    Plan for common question shapes, in the same shape the LLM planner emits.
+    Missing user/repo args are filled by _normalize_plan.
+    """
+    q = question.strip().rstrip("?.! ")
+
+    m = _LIST_REPOS_RE.match(q)
+    if m:
+        args = {"user": m.group("user")} if m.group("user") else {}
+        return {"type": "tool_plan", "tool_calls": [{"tool_name": "list_repos", "tool_args": args}]}
+
+    for pattern, tool_name in ((_OVERVIEW_RE, "get_repo_overview"), (_COMMITS_RE, "get_commit_timeline")):
+        m = pattern.match(q)
+        if not m:
+            continue
+        repo = m.group("repo")
+        if repo.lower() in _PRONOUNS:
+            if not (last_repo and last_repo_user):
+                return None
+            args = {}
+        else:
+            args = {"repo": repo}
+        return {"type": "tool_plan", "tool_calls": [{"tool_name": tool_name, "tool_args": args}]}
+
+    if (
+        last_repo
+        and last_repo_user
+        and _FOLLOWUP_REF_RE.search(q)
+        and not _MULTI_REPO_RE.search(q)
+        and not _names_other_repo(q, last_repo, last_repo_user)
+    ):
+        matched = [tool_name for pattern, tool_name in _FOLLOWUP_ROUTES if pattern.search(q)]
+        if len(matched) == 1:
+            return {"type": "tool_plan", "tool_calls": [{"tool_name": matched[0], "tool_args": {}}]}
+
+    return None
+
+
+# CLI history is capped at MAX_HISTORY messages; on overflow everything but
+# the last KEEP_VERBATIM is folded into one summary message at the front.
+MAX_HISTORY = 20
+KEEP_VERBATIM = 10
+SUMMARY_PREFIX = "Summary: "
+
+
+def _is_summary(m: Dict[str, str]) -> bool:
+    return m.get("role") == "system" and (m.get("content") or "").startswith(SUMMARY_PREFIX)
+
+
+def compress_history(history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """
+    Bound conversation history: keep recent turns verbatim and summarize the
+    rest (including any previous summary) with one LLM call. Summarizing in
+    chunks means this runs once every few turns, not on every turn.
+    """
+    if len(history) <= MAX_HISTORY:
+        return history
+
+    old, recent = history[:-KEEP_VERBATIM], history[-KEEP_VERBATIM:]
+    try:
+        resp = llm_synth.invoke([SUMMARIZE_SYSTEM, HumanMessage(content=_json_dumps(old))])
+        summary = (resp.content or "").strip()
+    except Exception:
+        # Fall back to a plain sliding window.
+        return recent
+    return [{"role": "system", "content": SUMMARY_PREFIX + summary}] + recent
+
+
+# Token budget for the conversation context sent to the planner.
+HISTORY_TOKEN_BUDGET = int(LLM_CFG.get("history_token_budget", 800))
 
 
-def _compact_history(history: List[Dict[str, str]], n: int = 6) -> str:
+def _approx_tokens(text: str) -> int:
+    # ~4 characters per token for English text; close enough for a budget.
+    return len(text) // 4 + 1
+
+
+def _compact_history(history: List[Dict[str, str]], n: int = 6, budget: int = HISTORY_TOKEN_BUDGET) -> str:
     """
-    Keep the last N messages as compact context for planning.
+    Keep the last N messages (plus the running summary, if any) as compact
+    context for planning. Messages are taken newest first until the token
+    budget is spent; one that does not fit whole is cut to its first sentence.
     """
     if not history:
         return ""
     recent = history[-n:]
+    if _is_summary(history[0]) and len(history) > n:
+        recent = [history[0]] + recent
     lines: List[str] = []
-    for m in recent:
+    used = 0
+    for m in reversed(recent):
         role = m.get("role", "")
         content = (m.get("content", "") or "").strip()
-        if content:
-            lines.append(f"{role}: {content}")
-    return "\n".join(lines)
+        if not content:
+            continue
+        line = f"{role}: {content}"
+        cost = _approx_tokens(line)
+        if used + cost > budget:
+            line = f"{role}: {_first_sentence(content)}"
+            cost = _approx_tokens(line)
+            if used + cost > budget:
+                break
+        lines.append(line)
+        used += cost
+    return "\n".join(reversed(lines))
 
 
 async def semantic_plan(state: AgentState) -> AgentState:
@@ -212,76 +798,254 @@ async def semantic_plan(state: AgentState) -> AgentState:
         state["tool_results"] = []
         return state
 
-    tools = await get_tool_catalog()
+    plan = _rule_plan(question, last_repo, last_repo_user)
+    if plan is not None:
+        _normalize_plan(state, plan, username, last_repo, last_repo_user)
+        return state
 
-    tool_brief = []
-    for t in tools:
-        tool_brief.append(
-            {
-                "name": t.get("name"),
-                "description": t.get("description", ""),
-                "inputSchema": t.get("inputSchema", {}),
-            }
-        )
+    cache_enabled = bool(CACHE_CFG.get("plan_cache_enabled", False))
+    cache_key = _plan_cache_key(question, username, last_repo_user, last_repo)
+    q_emb: Optional[List[float]] = None
+    if cache_enabled:
+        plan, q_emb = await _lookup_plan(cache_key)
+        if plan is None and q_emb is not None:
+            plan = _match_template(question, q_emb, username, last_repo, last_repo_user)
+
+    if plan is None:
+        prefetch: Dict[str, Any] = {}
+
+        def _start(raw_call: Dict[str, Any]) -> None:
+            # Calls that depend on an earlier result ($name) wait for execute_tools.
+            call = _normalize_call(raw_call, username, last_repo, last_repo_user)
+            args = call["tool_args"]
+            if not call["tool_name"] or any(isinstance(v, str) and v.startswith("$") for v in args.values()):
+                return
+            key = _call_key(call["tool_name"], args)
+            if key not in prefetch:
+                prefetch[key] = asyncio.create_task(_fetch_tool(call["tool_name"], dict(args), key))
+
+        plan = await _llm_plan(question, username, last_repo, last_repo_user, history, on_tool_call=_start)
+        state["prefetch"] = prefetch
+        if cache_enabled:
+            _store_plan(cache_key, q_emb, plan)
+            _store_template(question, q_emb, plan, username, last_repo, last_repo_user)
+
+    _normalize_plan(state, plan, username, last_repo, last_repo_user)
+    if state["plan"].get("type") != "tool_plan":
+        _drop_prefetch(state)
+    return state
 
-    context_note = ""
-    if last_repo and last_repo_user:
-        context_note = (
-            f"Last discussed repo: {last_repo_user}/{last_repo}. "
-            "If the user uses pronouns ('this project', 'that repo', 'it'), you may use it."
-        )
 
-    planner_system = SystemMessage(
-        content=(
-            "You are a semantic planner for a GitHub analysis assistant.\n"
-            "You MUST output a single JSON object only.\n\n"
-            "Your job:\n"
-            "- Decide whether the user needs tool calls.\n"
-            "- If so, select the best tool(s) from the provided catalog.\n"
-            "- Support multi-step plans when required (e.g., 'tech stack of latest project' needs list_repos then get_repo_overview).\n\n"
-            "Planning constraints:\n"
-            "- Prefer multi-repo tools for questions across repositories (e.g., 'any repo with CI/CD', 'which repos use Python').\n"
-            "- Prefer single-repo tools only when the question is explicitly about one repo or a pronoun refers to last repo.\n"
-            "- If the question is ambiguous and cannot be answered safely, propose a short clarification_question.\n\n"
-            "Output JSON schema:\n"
-            "{\n"
-            '  "type": "direct_answer" | "tool_plan" | "clarify",\n'
-            '  "answer": string (only for direct_answer),\n'
-            '  "clarification_question": string (only for clarify),\n'
-            '  "tool_calls": [\n'
-            "     {\"tool_name\": string, \"tool_args\": object, \"save_as\": string (optional)}\n"
-            "  ]\n"
-            "}\n"
-        )
-    )
+_JSON_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+
+def _extract_json_object(text: str) -> str:
+    """
+    Recover the JSON object from typical LLM formatting artifacts: markdown
+    fences, prose around the object, and trailing commas.
+    """
+    text = _JSON_FENCE_RE.sub("", text.strip())
+    start, end = text.find("{"), text.rfind("}")
+    if start != -1 and end > start:
+        text = text[start:end + 1]
+    return _TRAILING_COMMA_RE.sub(r"\1", text)
+
+
+class _ToolCallScanner:
+    """
+    Incrementally pull complete objects out of the "tool_calls" array of a
+    JSON plan that is still being streamed.
+    """
+
+    def __init__(self) -> None:
+        self._buf = ""
+        self._pos = -1  # scan position inside the tool_calls array; -1 until found
+        self._depth = 0
+        self._start = 0
+        self._in_str = False
+        self._escape = False
+        self._done = False
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        self._buf += text
+        if self._done:
+            return []
+        if self._pos < 0:
+            key = self._buf.find('"tool_calls"')
+            bracket = self._buf.find("[", key) if key >= 0 else -1
+            if bracket < 0:
+                return []
+            self._pos = bracket + 1
+
+        calls: List[Dict[str, Any]] = []
+        buf = self._buf
+        while self._pos < len(buf):
+            ch = buf[self._pos]
+            if self._in_str:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_str = False
+            elif ch == '"':
+                self._in_str = True
+            elif ch == "{":
+                if self._depth == 0:
+                    self._start = self._pos
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        call = _json_loads(buf[self._start:self._pos + 1])
+                    except json.JSONDecodeError:
+                        call = None
+                    if isinstance(call, dict):
+                        calls.append(call)
+            elif ch == "]" and self._depth == 0:
+                self._done = True
+                break
+            self._pos += 1
+        return calls
+
+
+def _needs_schema(raw: str) -> Optional[str]:
+    if '"needs_schema"' not in raw:
+        return None
+    try:
+        name = _json_loads(_extract_json_object(raw)).get("needs_schema")
+    except (json.JSONDecodeError, AttributeError):
+        return None
+    return name if isinstance(name, str) else None
+
+
+async def _llm_plan(
+    question: str,
+    username: str,
+    last_repo: Optional[str],
+    last_repo_user: Optional[str],
+    history: List[Dict[str, str]],
+    on_tool_call=None,
+) -> Dict[str, Any]:
+    """
+    Ask the planner LLM for a raw (un-normalized) plan. If `on_tool_call` is
+    given, the reply is streamed and it is called with each raw tool call as
+    soon as that call is fully generated.
+    """
+    tools = await get_tool_catalog()
 
+    context_note = f"Last discussed repo: {last_repo_user}/{last_repo}" if last_repo and last_repo_user else ""
+
+    planner_system = _planner_system(tools)
+
+    # Only per-turn data goes here; the static instructions and tool catalog
+    # stay in the system message so they form a byte-identical prefix.
     planner_user = HumanMessage(
         content=(
             f"Default GitHub user: {username}\n"
             f"{context_note}\n\n"
             "Recent conversation:\n"
             f"{_compact_history(history)}\n\n"
-            "Tool catalog:\n"
-            f"{json.dumps(tool_brief, indent=2)}\n\n"
             f"User question:\n{question}\n"
         )
     )
 
-    resp = llm.invoke([planner_system, planner_user])
-    raw = resp.content.strip()
-
-    # Strict JSON parse with one retry
-    try:
-        plan = json.loads(raw)
-    except json.JSONDecodeError:
-        retry = llm.invoke(
+    if on_tool_call is None:
+        raw = llm_planner.invoke([planner_system, planner_user]).content.strip()
+    else:
+        # Stream the plan and hand each tool call over as soon as its JSON
+        # object is complete, so it can start while the rest is generated.
+        scanner = _ToolCallScanner()
+        parts: List[str] = []
+        async for chunk in llm_planner.astream([planner_system, planner_user]):
+            parts.append(chunk.content or "")
+            for call in scanner.feed(chunk.content or ""):
+                on_tool_call(call)
+        raw = "".join(parts).strip()
+
+    # Rare path: the compact catalog was not enough, send that tool's schema.
+    name = _needs_schema(raw)
+    if name:
+        schema = next((t.get("inputSchema", {}) for t in tools if t.get("name") == name), {})
+        resp = llm_planner.invoke(
             [
-                SystemMessage(content="Return ONLY valid JSON matching the required schema. No text."),
+                planner_system,
                 planner_user,
+                HumanMessage(
+                    content=f"Input schema for {name}:\n{_json_dumps(schema)}\n\nNow return the JSON plan."
+                ),
             ]
         )
-        plan = json.loads(retry.content.strip())
+        raw = resp.content.strip()
+
+    # Strict JSON parse; repair formatting locally before paying for a retry.
+    try:
+        return _json_loads(raw)
+    except json.JSONDecodeError:
+        if PLANNER_JSON_MODE:
+            # JSON mode only yields invalid JSON when the reply was cut off at
+            # planner_max_tokens, which neither repair nor a retry can fix.
+            LOGGER.error("Planner reply in JSON mode did not parse (truncated?): %r", raw)
+            raise
+    try:
+        return _json_loads(_extract_json_object(raw))
+    except json.JSONDecodeError:
+        pass
+
+    retry = llm_planner.invoke([planner_system, planner_user, PLANNER_RETRY])
+    retry_raw = retry.content.strip()
+    try:
+        return _json_loads(_extract_json_object(retry_raw))
+    except json.JSONDecodeError:
+        LOGGER.error("Planner returned invalid JSON twice. First reply: %r Retry: %r", raw, retry_raw)
+        raise
+
+
+def _normalize_call(
+    c: Dict[str, Any],
+    username: str,
+    last_repo: Optional[str],
+    last_repo_user: Optional[str],
+) -> Dict[str, Any]:
+    tool_name = c.get("tool_name")
+    tool_args = c.get("tool_args", {}) or {}
+    if isinstance(tool_args, str):
+        # sometimes LLM emits tool_args as stringified json
+        try:
+            tool_args = _json_loads(tool_args)
+        except Exception:
+            tool_args = {}
+    else:
+        tool_args = dict(tool_args)
+
+    # default user
+    if "user" not in tool_args and username:
+        tool_args["user"] = username
+
+    # if repo required but missing, use last repo if available
+    if last_repo and last_repo_user and tool_name in _SINGLE_REPO_TOOLS and "repo" not in tool_args:
+        tool_args["repo"] = last_repo
+        tool_args["user"] = last_repo_user
+
+    return {
+        "tool_name": tool_name,
+        "tool_args": tool_args,
+        "save_as": c.get("save_as"),
+    }
+
 
+def _normalize_plan(
+    state: AgentState,
+    plan: Dict[str, Any],
+    username: str,
+    last_repo: Optional[str],
+    last_repo_user: Optional[str],
+) -> None:
+    """
+    Validate a raw plan and write it (with normalized tool calls) into state.
+    """
     # Post-processing: fill defaults, enforce user, handle pronouns for repo tools.
     plan_type = plan.get("type", "tool_plan")
     tool_calls = plan.get("tool_calls", []) or []
@@ -295,35 +1059,22 @@ async def semantic_plan(state: AgentState) -> AgentState:
             "Which repository (name) or which GitHub username should I use for this question?",
         )
 
-    # Normalize tool calls: ensure user default, handle pronoun repo reference
-    normalized_calls: List[Dict[str, Any]] = []
-    for c in tool_calls:
-        tool_name = c.get("tool_name")
-        tool_args = c.get("tool_args", {}) or {}
-        if isinstance(tool_args, str):
-            # sometimes LLM emits tool_args as stringified json
-            try:
-                tool_args = json.loads(tool_args)
-            except Exception:
-                tool_args = {}
-
-        # default user
-        if "user" not in tool_args and username:
-            tool_args["user"] = username
+    # A lone list_repos for a question about "this project" is a misread
+    # follow-up; the last repo's overview answers it without the listing.
+    # Questions that do ask for a listing keep the plan.
+    if (
+        plan_type == "tool_plan"
+        and len(tool_calls) == 1
+        and tool_calls[0].get("tool_name") == "list_repos"
+        and last_repo
+        and last_repo_user
+        and _FOLLOWUP_REF_RE.search(state["question"])
+        and not _LISTING_RE.search(state["question"])
+    ):
+        tool_calls = [{"tool_name": "get_repo_overview", "tool_args": {"user": last_repo_user, "repo": last_repo}}]
 
-        # if repo required but missing, use last repo if available
-        if tool_name in {"get_repo_overview", "get_commit_timeline", "get_repo_signals"}:
-            if "repo" not in tool_args and last_repo and last_repo_user:
-                tool_args["repo"] = last_repo
-                tool_args["user"] = last_repo_user
-
-        normalized_calls.append(
-            {
-                "tool_name": tool_name,
-                "tool_args": tool_args,
-                "save_as": c.get("save_as"),
-            }
-        )
+    # Normalize tool calls: ensure user default, handle pronoun repo reference
+    normalized_calls = [_normalize_call(c, username, last_repo, last_repo_user) for c in tool_calls]
 
     plan["type"] = plan_type
     plan["tool_calls"] = normalized_calls
@@ -331,92 +1082,308 @@ async def semantic_plan(state: AgentState) -> AgentState:
     state["plan"] = plan
     state["tool_calls"] = normalized_calls
     state["tool_results"] = []
-    return state
 
 # ============================================================
 # Execute tools (supports multi-step plans)
 # ============================================================
 
+def _plan_waves(tool_calls: List[Dict[str, Any]]) -> List[List[int]]:
+    """
+    Group tool calls into waves of mutually independent calls. A call that
+    references "$name" waits for the earlier call producing `name` (its
+    save_as, or list_repos for "latest" / "latest.repo").
+    """
+    producers: Dict[str, int] = {}
+    wave_of: List[int] = []
+    for i, call in enumerate(tool_calls):
+        wave = 0
+        for v in (call.get("tool_args") or {}).values():
+            if isinstance(v, str) and v.startswith("$") and v[1:] in producers:
+                wave = max(wave, wave_of[producers[v[1:]]] + 1)
+        wave_of.append(wave)
+
+        if call.get("save_as"):
+            producers[call["save_as"]] = i
+        if call.get("tool_name") == "list_repos":
+            producers["latest"] = producers["latest.repo"] = i
+
+    waves: List[List[int]] = [[] for _ in range(max(wave_of, default=-1) + 1)]
+    for i, wave in enumerate(wave_of):
+        waves[wave].append(i)
+    return waves
+
+
+def _call_key(tool_name: str, tool_args: Dict[str, Any]) -> str:
+    if orjson is not None:
+        return tool_name + orjson.dumps(tool_args, option=orjson.OPT_SORT_KEYS, default=str).decode("utf-8")
+    return tool_name + json.dumps(tool_args, sort_keys=True, separators=(",", ":"), default=str)
+
+
+# _call_key -> (expiry on the monotonic clock, data generation, JSON-safe
+# result). Repeat questions and follow-ups about the same repo skip the MCP
+# round trip. The generation is the user's _DATA_GENERATION when the result
+# was fetched; invalidate_tool_cache() bumps it after an ingestion, so older
+# entries stop matching.
+_TOOL_CACHE: Dict[str, Tuple[float, int, Any]] = {}
+TOOL_CACHE_TTL = float(CACHE_CFG.get("tool_cache_ttl", 60))
+TOOL_CACHE_TTL_BY_TOOL = {"list_repos": float(CACHE_CFG.get("list_repos_cache_ttl", 300))}
+TOOL_CACHE_MAX = 256
+
+# user -> data generation, bumped whenever an ingestion for that user ends.
+# Cache entries remember the generation they were fetched under, so results
+# taken before or during an ingestion are not served after it.
+_DATA_GENERATION: Dict[str, int] = {}
+
+
+def invalidate_tool_cache(user: str) -> None:
+    """
+    Mark every cached tool result for `user` stale. Call when an ingestion
+    for that user finishes (successfully or not).
+    """
+    _DATA_GENERATION[user] = _DATA_GENERATION.get(user, 0) + 1
+
+
+async def _fetch_tool(tool_name: str, tool_args: Dict[str, Any], key: str) -> Any:
+    """
+    Call a tool and return its unwrapped, JSON-safe result, reusing a recent
+    result of the identical call. Error and empty results are never cached:
+    an empty answer usually means the user's ingestion hasn't finished yet.
+    """
+    now = time.monotonic()
+    generation = _DATA_GENERATION.get(str(tool_args.get("user") or ""), 0)
+    hit = _TOOL_CACHE.get(key)
+    if hit is not None and hit[0] > now and hit[1] == generation:
+        return hit[2]
+
+    safe = make_json_safe(unwrap_mcp_content(await call_mcp_tool(tool_name, tool_args)))
+
+    ttl = TOOL_CACHE_TTL_BY_TOOL.get(tool_name, TOOL_CACHE_TTL)
+    empty = safe is None or safe == "" or safe == [] or safe == {}
+    if ttl > 0 and not empty and not (isinstance(safe, dict) and "error" in safe):
+        if len(_TOOL_CACHE) >= TOOL_CACHE_MAX:
+            for k in [k for k, (expires, _, _) in _TOOL_CACHE.items() if expires <= now]:
+                del _TOOL_CACHE[k]
+            if len(_TOOL_CACHE) >= TOOL_CACHE_MAX:
+                _TOOL_CACHE.pop(next(iter(_TOOL_CACHE)))
+        _TOOL_CACHE[key] = (now + ttl, generation, safe)
+    return safe
+
+
+def _drop_prefetch(state: AgentState) -> None:
+    """
+    Cancel prefetched calls the final plan did not use.
+    """
+    for task in (state.get("prefetch") or {}).values():
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled():
+            task.exception()  # mark retrieved; an unused failure is not an error
+    state["prefetch"] = None
+
+
+async def _run_one(call: Dict[str, Any], memory: Dict[str, Any], prefetch: Dict[str, Any]) -> Any:
+    tool_name = call.get("tool_name")
+    tool_args = call.get("tool_args") or {}
+
+    # Simple variable substitution if tool_args contains {"repo":"$latest.repo"} etc.
+    # We keep it conservative: only replace strings starting with "$".
+    for k, v in list(tool_args.items()):
+        if isinstance(v, str) and v.startswith("$"):
+            key = v[1:]
+            tool_args[k] = memory.get(key, v)
+    call["tool_args"] = tool_args
+
+    key = _call_key(cast(str, tool_name), tool_args)
+    task = prefetch.pop(key, None)
+    if task is not None:
+        return await task
+    return await _fetch_tool(cast(str, tool_name), cast(dict, tool_args), key)
+
+
+def _latest_repo(repos: Any) -> Optional[Dict[str, Any]]:
+    if isinstance(repos, list) and repos and isinstance(repos[0], dict):
+        return max(repos, key=lambda r: r.get("pushed_at") or "")
+    return None
+
+
+def _last_repo_update(
+    tool_name: Optional[str],
+    tool_args: Dict[str, Any],
+    result: Any,
+    latest_repo: Optional[str],
+    username: str,
+) -> Optional[Tuple[str, str]]:
+    """
+    (repo, user) that becomes the conversational "last repo" after a call, if any.
+    """
+    if tool_name == "list_repos":
+        return (latest_repo, username) if latest_repo else None
+    if (
+        tool_name in _SINGLE_REPO_TOOLS
+        and isinstance(result, dict)
+        and "error" not in result
+        and "repo" in tool_args
+        and "user" in tool_args
+    ):
+        return (tool_args["repo"], tool_args["user"])
+    return None
+
+
 async def execute_tools(state: AgentState) -> AgentState:
     plan = state.get("plan") or {}
     if plan.get("type") != "tool_plan":
+        _drop_prefetch(state)
         state["tool_results"] = []
         return state
 
     tool_calls = state.get("tool_calls") or []
-    results: List[Dict[str, Any]] = []
+    results: List[Optional[Dict[str, Any]]] = [None] * len(tool_calls)
+    prefetch = state.get("prefetch") or {}
 
     # Used for simple in-plan passing (save_as references)
     memory: Dict[str, Any] = {}
+    username = state.get("username") or CONFIG.get("github", {}).get("default_user", "")
 
-    for i, call in enumerate(tool_calls):
-        tool_name = call.get("tool_name")
-        tool_args = call.get("tool_args") or {}
-
-        # Simple variable substitution if tool_args contains {"repo":"$latest.repo"} etc.
-        # We keep it conservative: only replace strings starting with "$".
-        for k, v in list(tool_args.items()):
-            if isinstance(v, str) and v.startswith("$"):
-                key = v[1:]
-                tool_args[k] = memory.get(key, v)
-
-        raw = await call_mcp_tool(cast(str, tool_name), cast(dict, tool_args))
-        unwrapped = unwrap_mcp_content(raw)
-        safe = make_json_safe(unwrapped)
-
-        # Save-as support
-        save_as = call.get("save_as")
-        if save_as:
-            memory[save_as] = safe
-
-        # Convenience: if list_repos, store latest repo name for downstream steps
-        if tool_name == "list_repos":
-            repos = safe
-            if isinstance(repos, str):
-                try:
-                    repos = json.loads(repos)
-                except Exception:
-                    repos = None
-            if isinstance(repos, list) and repos and isinstance(repos[0], dict):
-                latest = sorted(repos, key=lambda r: r.get("pushed_at", "") or "", reverse=True)[0]
-                latest_repo = latest.get("repo") or latest.get("name")
-                memory["latest.repo"] = latest_repo
-                memory["latest"] = latest
-
-                # update conversational "last repo"
-                if latest_repo:
-                    state["last_repo"] = latest_repo
-                    state["last_repo_user"] = (state.get("username") or CONFIG.get("github", {}).get("default_user", ""))
-
-        # Update last repo context on single-repo tools
-        if tool_name in {"get_repo_overview", "get_commit_timeline", "get_repo_signals"}:
-            if isinstance(safe, dict) and "error" not in safe:
-                if "repo" in tool_args and "user" in tool_args:
-                    state["last_repo"] = tool_args["repo"]
-                    state["last_repo_user"] = tool_args["user"]
-
-        results.append(
-            {
+    # Independent calls run concurrently; side effects (memory, last repo) are
+    # applied after each wave in plan order, so they stay deterministic.
+    for wave in _plan_waves(tool_calls):
+        outputs = await asyncio.gather(*[_run_one(tool_calls[i], memory, prefetch) for i in wave])
+
+        for i, safe in zip(wave, outputs):
+            call = tool_calls[i]
+            tool_name = call.get("tool_name")
+            tool_args = call.get("tool_args") or {}
+
+            # Save-as support
+            save_as = call.get("save_as")
+            if save_as:
+                memory[save_as] = safe
+
+            # Convenience: if list_repos, store latest repo name for downstream steps
+            latest_repo = None
+            if tool_name == "list_repos":
+                latest = _latest_repo(safe)
+                if latest:
+                    latest_repo = latest.get("repo") or latest.get("name")
+                    memory["latest.repo"] = latest_repo
+                    memory["latest"] = latest
+
+            # Update conversational "last repo"
+            update = _last_repo_update(tool_name, tool_args, safe, latest_repo, username)
+            if update:
+                state["last_repo"], state["last_repo_user"] = update
+
+            results[i] = {
                 "tool_name": tool_name,
                 "tool_args": make_json_safe(tool_args),
                 "result": safe,
             }
-        )
 
-    state["tool_results"] = results
+        # A tool error becomes the answer as-is (see synthesize_answer), so
+        # later waves would only add MCP calls nobody reads.
+        if any(isinstance(out, dict) and out.get("error") for out in outputs):
+            break
+
+    _drop_prefetch(state)
+    state["tool_results"] = [r for r in results if r is not None]
     return state
 
+
 # ============================================================
 # Synthesis (grounded answer)
 # ============================================================
 
-def synthesize_answer(state: AgentState) -> AgentState:
+def _emit_chunk(state: AgentState, text: str) -> None:
+    if state.get("stream"):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+    on_token = state.get("on_token")
+    if on_token is not None and text:
+        on_token(text)
+
+
+def _emit_answer(state: AgentState, text: str) -> None:
+    """
+    In streaming mode every answer, generated or not, is emitted here, so
+    the caller never shows it a second time.
+    """
+    if state.get("stream"):
+        sys.stdout.write("\nAnswer:\n ")
+    _emit_chunk(state, text)
+
+
+# Prompt trimming for tool output: fields the answer never needs, and caps
+# for long text (README bodies, commit messages). Only commit lists are capped
+# by default: counting/filtering questions need every repo.
+SYNTH_DROP_KEYS = frozenset({"sha"})
+SYNTH_MAX_STRING = 1500
+SYNTH_MAX_ITEMS = 50
+SYNTH_CAPPED_TOOLS = frozenset({"get_commit_timeline"})
+# Bundles still over this many (approximate) tokens are trimmed harder: first
+# low-value columns and long text go, and only then rows.
+SYNTH_TOKEN_BUDGET = int(LLM_CFG.get("synth_token_budget", 6000))
+SYNTH_LOW_VALUE_KEYS = SYNTH_DROP_KEYS | {
+    "topics", "watchers_count", "open_issues_count", "size",
+    "created_at", "updated_at", "html_url", "license_name",
+}
+SYNTH_TRIM_STRING = 300
+SYNTH_TRIM_ITEMS = 20
+
+
+def _compact_for_prompt(
+    obj: Any,
+    max_string: int = SYNTH_MAX_STRING,
+    max_items: Optional[int] = None,
+    drop_keys: frozenset = SYNTH_DROP_KEYS,
+) -> Any:
+    """
+    Trim `obj` for the prompt. A list cut to `max_items` becomes
+    {"items": [...], "total": n, "truncated": true}, so the model still
+    knows the real count and that it is looking at a sample.
+    """
+    if isinstance(obj, str):
+        return obj if len(obj) <= max_string else obj[:max_string] + "…"
+    if isinstance(obj, dict):
+        return {
+            k: _compact_for_prompt(v, max_string, max_items, drop_keys) for k, v in obj.items() if k not in drop_keys
+        }
+    if isinstance(obj, list):
+        items = [_compact_for_prompt(x, max_string, max_items, drop_keys) for x in obj[:max_items]]
+        if max_items is not None and len(obj) > max_items:
+            return {"items": items, "total": len(obj), "truncated": True}
+        return items
+    return obj
+
+
+def _prompt_results(tool_results: List[Dict[str, Any]], level: int = 0) -> List[Dict[str, Any]]:
+    """
+    Level 0: default caps. Level 1: also drop low-value columns and shorten
+    text. Level 2: additionally cap every list at SYNTH_TRIM_ITEMS rows.
+    """
+    out = []
+    for tr in tool_results:
+        capped = tr["tool_name"] in SYNTH_CAPPED_TOOLS
+        if level == 0:
+            result = _compact_for_prompt(tr["result"], max_items=SYNTH_MAX_ITEMS if capped else None)
+        else:
+            result = _compact_for_prompt(
+                tr["result"],
+                max_string=SYNTH_TRIM_STRING,
+                max_items=SYNTH_TRIM_ITEMS if capped or level >= 2 else None,
+                drop_keys=SYNTH_LOW_VALUE_KEYS,
+            )
+        out.append({"tool_name": tr["tool_name"], "tool_args": tr["tool_args"], "result": result})
+    return out
+
+
+async def synthesize_answer(state: AgentState) -> AgentState:
     plan = state.get("plan") or {}
 
     # Direct answer path
     if plan.get("type") == "direct_answer":
         answer = plan.get("answer") or ""
         state["final_answer"] = answer
+        _emit_answer(state, answer)
         # persist history
         hist = state.get("conversation_history") or []
         hist.append({"role": "user", "content": state["question"]})
@@ -428,6 +1395,7 @@ def synthesize_answer(state: AgentState) -> AgentState:
     if plan.get("type") == "clarify":
         cq = plan.get("clarification_question") or "Can you clarify what repository or GitHub user you mean?"
         state["final_answer"] = cq
+        _emit_answer(state, cq)
         hist = state.get("conversation_history") or []
         hist.append({"role": "user", "content": state["question"]})
         hist.append({"role": "assistant", "content": cq})
@@ -446,40 +1414,42 @@ def synthesize_answer(state: AgentState) -> AgentState:
                 "If this is a missing-ingestion issue, re-run ingestion and retry."
             )
             state["final_answer"] = msg
+            _emit_answer(state, msg)
             hist = state.get("conversation_history") or []
             hist.append({"role": "user", "content": state["question"]})
             hist.append({"role": "assistant", "content": msg})
             state["conversation_history"] = hist
             return state
 
-    synthesis_system = SystemMessage(
-        content=(
-            "You are a GitHub analysis assistant. You MUST answer using ONLY the provided tool outputs.\n\n"
-            "Rules:\n"
-            "- If the question is about tech stack, prioritize detected tech stack fields (e.g., signals.tech_stack) over repo.language.\n"
-            "- For multi-repo questions (CI/CD, tests, Docker, language usage), summarize across repositories using the multi-repo tool results.\n"
-            "- If the tool output lacks a detail, explicitly say it is not available.\n"
-            "- Do not hallucinate frameworks/tools that are not in tool outputs.\n"
-        )
-    )
-
-    # IMPORTANT: ensure JSON-serializable
-    tool_bundle = {
-        "question": state["question"],
-        "username": state.get("username") or CONFIG.get("github", {}).get("default_user", ""),
-        "last_repo": state.get("last_repo"),
-        "tool_results": tool_results,
+    # Tool results were made JSON-safe once in execute_tools; here they are
+    # only trimmed to what is worth sending to the model.
+    safe_bundle = {
+        "question": make_json_safe(state["question"]),
+        "username": make_json_safe(state.get("username") or CONFIG.get("github", {}).get("default_user", "")),
+        "last_repo": make_json_safe(state.get("last_repo")),
+        "tool_results": _prompt_results(tool_results),
     }
-    safe_bundle = make_json_safe(tool_bundle)
-
-    resp = llm.invoke(
-        [
-            synthesis_system,
-            HumanMessage(content=json.dumps(safe_bundle, indent=2)),
-        ]
-    )
-
-    answer = resp.content
+    content = _json_dumps(safe_bundle)
+    for level in (1, 2):
+        if _approx_tokens(content) <= SYNTH_TOKEN_BUDGET:
+            break
+        # Many repos / long READMEs: trim harder rather than overflow the context.
+        safe_bundle["tool_results"] = _prompt_results(tool_results, level)
+        content = _json_dumps(safe_bundle)
+
+    messages = [SYNTH_SYSTEM, HumanMessage(content=content)]
+
+    if state.get("stream") or state.get("on_token"):
+        # Emit tokens as they arrive instead of waiting for the full answer.
+        _emit_answer(state, "")
+        chunks: List[str] = []
+        async for chunk in llm_synth.astream(messages):
+            text = chunk.content or ""
+            _emit_chunk(state, text)
+            chunks.append(text)
+        answer = "".join(chunks)
+    else:
+        answer = (await llm_synth.ainvoke(messages)).content
     state["final_answer"] = answer
 
     hist = state.get("conversation_history") or []
@@ -497,8 +1467,13 @@ graph.add_node("semantic_plan", semantic_plan)
 graph.add_node("execute_tools", execute_tools)
 graph.add_node("synthesize_answer", synthesize_answer)
 
+def _route_after_plan(state: AgentState) -> str:
+    # Direct answers and clarifications have nothing to execute.
+    return "execute_tools" if (state.get("plan") or {}).get("type") == "tool_plan" else "synthesize_answer"
+
+
 graph.set_entry_point("semantic_plan")
-graph.add_edge("semantic_plan", "execute_tools")
+graph.add_conditional_edges("semantic_plan", _route_after_plan, ["execute_tools", "synthesize_answer"])
 graph.add_edge("execute_tools", "synthesize_answer")
 graph.add_edge("synthesize_answer", END)
 
@@ -508,42 +1483,53 @@ agent = graph.compile()
 # CLI entrypoint (keeps conversation context across turns)
 # ============================================================
 
-def main() -> None:
-    print("GitHub MCP Agent (LangGraph) — Semantic Planner + Multi-Repo Tools")
-    print("Type 'exit' or 'quit' to stop.\n")
-
+async def _repl() -> None:
     # Persist context across turns
     conversation_history: List[Dict[str, str]] = []
     last_repo: Optional[str] = None
     last_repo_user: Optional[str] = None
+    loop = asyncio.get_running_loop()
 
-    while True:
-        question = input("Question: ").strip()
-        if question.lower() in {"exit", "quit"}:
-            break
+    try:
+        while True:
+            # input() blocks, so run it off the loop; the loop (and the MCP
+            # session it owns) stays alive across turns.
+            question = (await loop.run_in_executor(None, input, "Question: ")).strip()
+            if question.lower() in {"exit", "quit"}:
+                break
+
+            initial_state: AgentState = {
+                "question": question,
+                "username": CONFIG.get("github", {}).get("default_user"),
+                "conversation_history": conversation_history,
+                "last_repo": last_repo,
+                "last_repo_user": last_repo_user,
+                "plan": None,
+                "tool_calls": None,
+                "tool_results": None,
+                "final_answer": None,
+                "stream": True,
+            }
 
-        initial_state: AgentState = {
-            "question": question,
-            "username": CONFIG.get("github", {}).get("default_user"),
-            "conversation_history": conversation_history,
-            "last_repo": last_repo,
-            "last_repo_user": last_repo_user,
-            "plan": None,
-            "tool_calls": None,
-            "tool_results": None,
-            "final_answer": None,
-        }
+            # The answer is printed by synthesize_answer as it streams.
+            result = await agent.ainvoke(initial_state)
+
+            print("\n\n" + "-" * 60 + "\n")
+
+            # Carry forward context
+            conversation_history = compress_history(result.get("conversation_history", conversation_history))
+            last_repo = result.get("last_repo", last_repo)
+            last_repo_user = result.get("last_repo_user", last_repo_user)
+    finally:
+        await shutdown()
 
-        result = asyncio.run(agent.ainvoke(initial_state))
 
-        # Print
-        print("\nAnswer:\n", result.get("final_answer", ""))
-        print("\n" + "-" * 60 + "\n")
+def main() -> None:
+    print("GitHub MCP Agent (LangGraph) — Semantic Planner + Multi-Repo Tools")
+    print("Type 'exit' or 'quit' to stop.\n")
 
-        # Carry forward context
-        conversation_history = result.get("conversation_history", conversation_history)
-        last_repo = result.get("last_repo", last_repo)
-        last_repo_user = result.get("last_repo_user", last_repo_user)
+    # One event loop for the whole session instead of asyncio.run per turn.
+    asyncio.run(_repl())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,14 +1,12 @@
 import streamlit as st
-import asyncio
+import copy
 import os
-import requests
+import queue
+import threading
+import time
+from html import escape
 
-# Try importing local agent (only works in local mode)
-try:
-    from agent import agent
-    LOCAL_AGENT_AVAILABLE = True
-except:
-    LOCAL_AGENT_AVAILABLE = False
+from theme import APP_CSS
 
 
 # =========================
@@ -16,6 +14,7 @@ except:
 # =========================
 DEPLOY_MODE = os.getenv("DEPLOY_MODE", "cloud")  # local | cloud
 API_BASE = os.getenv("API_BASE", "http://44.198.180.55:8000")  # EC2 API
+MAX_HISTORY = 40  # agent history messages kept per session
 
 
 # =========================
@@ -27,42 +26,32 @@ st.set_page_config(page_title="BitofGit", layout="wide")
 # =========================
 # Theme
 # =========================
-st.markdown("""
-<style>
-.stApp { background-color: #f2f3f5; color: #1f2328; font-family: Inter, Segoe UI, sans-serif; }
-h1 { text-align: center; color: #1f2328; font-weight: 700; margin-bottom: 1.2rem; }
-button { background-color: #e6e8eb !important; color: #1f2328 !important;
-         border: 1px solid #6b8e23 !important; border-radius: 10px !important;
-         padding: 8px 14px !important; }
-.chat-message { background-color: #ffffff; border: 1px solid #d0d7de;
-                padding: 14px 16px; border-radius: 12px; margin-bottom: 14px;
-                box-shadow: 0 2px 8px rgba(0,0,0,0.06); }
-.user-message { border-left: 5px solid #6b8e23; }
-.assistant-message { border-left: 5px solid #5a5a5a; }
-textarea, input { background-color: #ffffff !important; color: #1f2328 !important;
-                  border: 1px solid #d0d7de !important; border-radius: 10px !important; }
-.stChatInput button, .stChatInput svg { display: none !important; }
-</style>
-""", unsafe_allow_html=True)
+st.markdown(APP_CSS, unsafe_allow_html=True)
 
 
 # =========================
 # Session State
 # =========================
-defaults = {
+# Module constant, so the dict isn't rebuilt on every rerun. Copied into each
+# new session so the lists are never shared between sessions.
+DEFAULTS = {
     "messages": [],
+    "history": [],  # agent conversation history, kept in step with messages
     "git_user_name": "",
     "git_token": "",
     "show_settings": False,
     "settings_saved": False,
     "ingested": False,
+    "ingest_status": None,  # last ingestion status reported by the backend
+    "ingest_status_at": 0.0,  # time.monotonic() of that report
     "last_repo": None,
     "last_repo_user": None,
 }
 
-for key, val in defaults.items():
-    if key not in st.session_state:
-        st.session_state[key] = val
+if "_initialized" not in st.session_state:
+    for key, val in DEFAULTS.items():
+        st.session_state.setdefault(key, copy.copy(val))
+    st.session_state._initialized = True
 
 
 # =========================
@@ -81,29 +70,35 @@ with st.container():
 if st.session_state.show_settings:
     with st.expander("Settings", expanded=True):
 
-        git_user_name = st.text_input("GitHub Username", value=st.session_state.git_user_name)
-        git_token = st.text_input("GitHub Token", value=st.session_state.git_token, type="password")
-
-        col_reset, col_ok = st.columns(2)
-
-        with col_reset:
-            if st.button("Reset"):
-                st.session_state.git_user_name = ""
-                st.session_state.git_token = ""
-                st.session_state.settings_saved = False
-                st.session_state.ingested = False
+        # A form: typing in the fields doesn't rerun the script, only the
+        # Reset / OK buttons do.
+        with st.form("settings_form", clear_on_submit=False):
+            git_user_name = st.text_input("GitHub Username", value=st.session_state.git_user_name)
+            git_token = st.text_input("GitHub Token", value=st.session_state.git_token, type="password")
+
+            col_reset, col_ok = st.columns(2)
+            with col_reset:
+                reset = st.form_submit_button("Reset")
+            with col_ok:
+                ok = st.form_submit_button("OK", disabled=st.session_state.settings_saved)
+
+        if reset:
+            st.session_state.git_user_name = ""
+            st.session_state.git_token = ""
+            st.session_state.settings_saved = False
+            st.session_state.ingested = False
+            st.session_state.ingest_status = None
+            st.rerun()
+
+        if ok:
+            if git_user_name and git_token:
+                st.session_state.git_user_name = git_user_name
+                st.session_state.git_token = git_token
+                st.session_state.settings_saved = True
+                st.success("Settings saved!")
                 st.rerun()
-
-        with col_ok:
-            if st.button("OK", disabled=st.session_state.settings_saved):
-                if git_user_name and git_token:
-                    st.session_state.git_user_name = git_user_name
-                    st.session_state.git_token = git_token
-                    st.session_state.settings_saved = True
-                    st.success("Settings saved!")
-                    st.rerun()
-                else:
-                    st.info("Please fill in both fields")
+            else:
+                st.info("Please fill in both fields")
 
 
 # =========================
@@ -113,9 +108,31 @@ def has_credentials():
     return bool(st.session_state.git_user_name and st.session_state.git_token)
 
 
+@st.cache_resource
+def get_http_session():
+    # Shared by every rerun and session so the API connection (and its TLS
+    # handshake) is reused. Only connection failures are retried: the POSTs
+    # here are not safe to repeat after the server has seen them.
+    # requests is imported here, once, rather than on every script rerun.
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["Accept"] = "application/json"
+    return session
+
+
 def call_cloud_ingest():
     try:
-        r = requests.post(
+        r = get_http_session().post(
             f"{API_BASE}/ingest",
             json={
                 "user_name": st.session_state.git_user_name,
@@ -126,6 +143,9 @@ def call_cloud_ingest():
 
         if r.status_code in [200,202]:
             st.session_state.ingested = True
+            st.session_state.ingest_status = None
+            # Answers cached before this ingestion may be out of date.
+            cached_cloud_query.clear()
             st.success("Ingestion started in background.")
         else:
             st.error(f"Ingestion failed: {r.text}")
@@ -134,49 +154,118 @@ def call_cloud_ingest():
         st.error(f"API ingest error: {e}")
 
 
+def post_cloud_query(api_base, user_name, prompt):
+    r = get_http_session().post(
+        f"{api_base}/query",
+        json={
+            "user_name": user_name,
+            "question": prompt
+        },
+        timeout=120
+    )
+    r.raise_for_status()
+    return r.json().get("answer", "No response")
+
+
+@st.cache_data(ttl=600, show_spinner=False)
+def cached_cloud_query(api_base, user_name, prompt):
+    # Cloud queries carry no conversation state, so the answer depends only on
+    # these arguments. Errors raise, so they are never cached. Only used once
+    # ingestion has finished: answers given mid-ingestion are incomplete.
+    return post_cloud_query(api_base, user_name, prompt)
+
+
+INGEST_TERMINAL_STATUSES = ("completed", "failed")
+INGEST_STATUS_RECHECK = 15.0  # seconds between status checks while running
+
+
+def ingestion_complete():
+    # A terminal status is final until the next ingestion; while it is still
+    # running the backend is asked at most every INGEST_STATUS_RECHECK seconds,
+    # so most sends make no status request at all.
+    status = st.session_state.ingest_status
+    stale = time.monotonic() - st.session_state.ingest_status_at >= INGEST_STATUS_RECHECK
+    if status not in INGEST_TERMINAL_STATUSES and stale:
+        try:
+            r = get_http_session().get(f"{API_BASE}/users/{st.session_state.git_user_name}", timeout=10)
+            status = r.json().get("status") if r.ok else None
+        except Exception:
+            status = None
+        st.session_state.ingest_status = status
+        st.session_state.ingest_status_at = time.monotonic()
+    return status == "completed"
+
+
 def call_cloud_query(prompt):
     try:
-        r = requests.post(
-            f"{API_BASE}/query",
-            json={
-                "user_name": st.session_state.git_user_name,
-                "question": prompt
-            },
-            timeout=120
-        )
-        return r.json().get("answer", "No response")
+        query = cached_cloud_query if ingestion_complete() else post_cloud_query
+        return query(API_BASE, st.session_state.git_user_name, prompt)
     except Exception as e:
         return f"API query error: {e}"
 
 
-def call_local_agent(prompt):
-    os.environ["GITHUB_TOKEN"] = st.session_state.git_token
+@st.cache_resource
+def get_agent():
+    # Imported on first local-mode question only (cloud mode never pays for
+    # langchain/langgraph), then shared by every rerun and session.
+    try:
+        from agent import agent
+        return agent
+    except Exception:
+        return None
 
-    conversation_history = [
-        {"role": m["role"], "content": m["content"]}
-        for m in st.session_state.messages[:-1]
-    ]
+
+@st.cache_resource
+def get_event_loop():
+    # One long-lived loop for the whole server instead of asyncio.run per
+    # question: the agent's MCP session is bound to the loop that opened it,
+    # so reusing the loop keeps the server process and session alive.
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def stream_local_agent(prompt):
+    """
+    Yield the answer text as the agent generates it.
+    """
+    os.environ["GITHUB_TOKEN"] = st.session_state.git_token
+    tokens = queue.Queue()
 
     initial_state = {
         "question": prompt,
         "username": st.session_state.git_user_name,
-        "conversation_history": conversation_history,
+        "conversation_history": st.session_state.history,
         "last_repo": st.session_state.last_repo,
         "last_repo_user": st.session_state.last_repo_user,
-        "tool_name": None,
-        "tool_args": None,
-        "tool_result": None,
+        "plan": None,
+        "tool_calls": None,
+        "tool_results": None,
         "final_answer": None,
+        "on_token": tokens.put,
     }
 
-    result = asyncio.run(agent.ainvoke(initial_state))
+    # The agent runs on the background loop; its tokens are handed to this
+    # (script) thread through the queue, and None marks the end of the turn.
+    import asyncio
+
+    future = asyncio.run_coroutine_threadsafe(get_agent().ainvoke(initial_state), get_event_loop())
+    future.add_done_callback(lambda _: tokens.put(None))
+    while (text := tokens.get()) is not None:
+        yield text
+    result = future.result()
+
+    # The agent appends this turn to the history it was given.
+    history = result.get("conversation_history") or st.session_state.history
+    del history[:-MAX_HISTORY]
+    st.session_state.history = history
 
     if result.get("last_repo"):
         st.session_state.last_repo = result.get("last_repo")
         st.session_state.last_repo_user = result.get("last_repo_user")
 
-    return result.get("final_answer", "No response")
-
 
 # =========================
 # Title
@@ -187,10 +276,22 @@ st.markdown("<h1>BitofGit 🤖</h1>", unsafe_allow_html=True)
 # =========================
 # Chat History
 # =========================
-for message in st.session_state.messages:
-    css = "user-message" if message["role"] == "user" else "assistant-message"
-    st.markdown(f'<div class="chat-message {css}">{message["content"]}</div>',
-                unsafe_allow_html=True)
+def message_html(role, content):
+    css = "user-message" if role == "user" else "assistant-message"
+    # Escaped: message text (user input, model output) must not inject HTML.
+    return f'<div class="chat-message {css}">{escape(content)}</div>'
+
+
+def render_message(role, content, target=st):
+    target.markdown(message_html(role, content), unsafe_allow_html=True)
+
+
+# One element for the whole history instead of one per message.
+if st.session_state.messages:
+    st.markdown(
+        "".join(message_html(m["role"], m["content"]) for m in st.session_state.messages),
+        unsafe_allow_html=True,
+    )
 
 
 # =========================
@@ -198,12 +299,17 @@ for message in st.session_state.messages:
 # =========================
 if prompt := st.chat_input("Press Enter to send • Shift+Enter for new line"):
 
+    # New messages are rendered in place below the history instead of
+    # re-running the whole script to redraw every message.
     st.session_state.messages.append({"role": "user", "content": prompt})
+    render_message("user", prompt)
+    response_placeholder = st.empty()
 
     if not has_credentials():
         response = "Please configure your GitHub username and token in Settings."
         st.session_state.messages.append({"role": "assistant", "content": response})
-        st.rerun()
+        render_message("assistant", response, response_placeholder)
+        st.stop()
 
     with st.spinner("Thinking..."):
         try:
@@ -219,13 +325,14 @@ if prompt := st.chat_input("Press Enter to send • Shift+Enter for new line"):
             if DEPLOY_MODE == "cloud":
                 response = call_cloud_query(prompt)
             else:
-                if not LOCAL_AGENT_AVAILABLE:
+                if get_agent() is None:
                     response = "Local agent not available."
                 else:
-                    response = call_local_agent(prompt)
+                    with response_placeholder.container():
+                        response = st.write_stream(stream_local_agent(prompt)) or "No response"
 
         except Exception as e:
             response = f"Error: {str(e)}"
 
     st.session_state.messages.append({"role": "assistant", "content": response})
-    st.rerun()
\ No newline at end of file
+    render_message("assistant", response, response_placeholder)
\ No newline at end of file
@@ -0,0 +1,22 @@
+"""
+Streamlit theme for the chat app. Kept in its own module so the stylesheet
+is built once per process (on import) rather than on every script rerun.
+"""
+
+APP_CSS = """
+<style>
+.stApp { background-color: #f2f3f5; color: #1f2328; font-family: Inter, Segoe UI, sans-serif; }
+h1 { text-align: center; color: #1f2328; font-weight: 700; margin-bottom: 1.2rem; }
+button { background-color: #e6e8eb !important; color: #1f2328 !important;
+         border: 1px solid #6b8e23 !important; border-radius: 10px !important;
+         padding: 8px 14px !important; }
+.chat-message { background-color: #ffffff; border: 1px solid #d0d7de;
+                padding: 14px 16px; border-radius: 12px; margin-bottom: 14px;
+                box-shadow: 0 2px 8px rgba(0,0,0,0.06); }
+.user-message { border-left: 5px solid #6b8e23; }
+.assistant-message { border-left: 5px solid #5a5a5a; }
+textarea, input { background-color: #ffffff !important; color: #1f2328 !important;
+                  border: 1px solid #d0d7de !important; border-radius: 10px !important; }
+.stChatInput button, .stChatInput svg { display: none !important; }
+</style>
+"""
@@ -1,14 +1,19 @@
 from __future__ import annotations
 
+import json
 import logging
 import os
+import re
 import sqlite3
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
 from typing import Any, Optional
 
 try:
     import psycopg2
-    from psycopg2.extras import RealDictCursor
+    from psycopg2.extras import RealDictCursor, execute_batch, execute_values
 except ImportError:
     psycopg2 = None
 
@@ -17,15 +22,25 @@ try:
 except ImportError:
     load_dotenv = None
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 LOGGER = logging.getLogger("github_mcp")
 logging.basicConfig(level=logging.INFO)
 
+@lru_cache(maxsize=1)
 def get_db_mode() -> str:
     """
     Determine DB_MODE with priority:
     1. If .env has DB_MODE=sqlite, use sqlite
     2. Otherwise, if DB_MODE is set in environment variables, use that
     3. Otherwise, default to postgres
+
+    Every DB helper asks for the mode, so it is resolved once per process
+    instead of re-reading secrets.env each time. Call refresh_db_mode()
+    after changing DB_MODE at runtime.
     """
     # First, check .env file directly for DB_MODE=sqlite
     env_path = Path(__file__).parent / "secrets.env"
@@ -56,9 +71,35 @@ def get_db_mode() -> str:
     # Default to postgres
     return "postgres"
 
+def refresh_db_mode() -> str:
+    get_db_mode.cache_clear()
+    return get_db_mode()
+
 def get_database_url() -> Optional[str]:
     return os.environ.get("DATABASE_URL")
 
+# =========================
+# JSON (orjson when installed)
+# =========================
+
+def json_loads(data: str | bytes) -> Any:
+    """
+    Parse JSON, using orjson when available (several times faster on large
+    GitHub payloads such as recursive trees).
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj: Any) -> str:
+    """
+    Serialize to compact JSON text, using orjson when available.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, separators=(",", ":"))
+
 # =========================
 # ENV HELPERS (DYNAMIC)
 # =========================
@@ -74,13 +115,25 @@ def adapt_sql(sql: str) -> str:
     Converts %s placeholders to ? for SQLite automatically.
     """
     if get_db_mode() == "sqlite":
-        return sql.replace("%s", "?")
+        return _qmark_sql(sql)
     return sql
 
+
+@lru_cache(maxsize=256)
+def _qmark_sql(sql: str) -> str:
+    # The same few statements are adapted on every write; rewrite each once.
+    return sql.replace("%s", "?")
+
 # =========================
 # CONNECTION
 # =========================
 
+@lru_cache(maxsize=None)
+def _ensure_db_dir(directory: Path) -> None:
+    # connect() runs for every request; the directory only needs creating once.
+    directory.mkdir(parents=True, exist_ok=True)
+
+
 def connect():
     db_mode = get_db_mode()
     database_url = get_database_url()
@@ -109,13 +162,68 @@ def connect():
         
         return conn
 
-    SQLITE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    _ensure_db_dir(SQLITE_PATH.parent)
     LOGGER.warning("⚠️ Using local SQLite DB at %s", SQLITE_PATH)
 
-    conn = sqlite3.connect(SQLITE_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+    # Writes run in `with conn:` blocks; IMMEDIATE makes the implicit BEGIN
+    # take the write lock up front, so a transaction never fails midway
+    # trying to upgrade from a read lock while another connection writes.
+    conn = sqlite3.connect(SQLITE_PATH, check_same_thread=False, isolation_level="IMMEDIATE")
+    conn.row_factory = _dict_row
+    _apply_sqlite_pragmas(conn)
+    return conn
+
+
+_THREAD = threading.local()
+
+
+def thread_connection():
+    """
+    Return this thread's connection for the current DB mode, opening it on
+    first use. For short per-request reads/writes that would otherwise pay
+    for a new connection (a TCP+TLS+auth handshake in Postgres mode) every
+    call. Callers must not close it.
+    """
+    conns = getattr(_THREAD, "conns", None)
+    if conns is None:
+        conns = _THREAD.conns = {}
+    key = get_db_mode()
+    conn = conns.get(key)
+    if conn is None or getattr(conn, "closed", False):
+        conn = conns[key] = connect()
     return conn
 
+
+# (cursor.description, column names) of the last result set seen by _dict_row.
+_ROW_NAMES: tuple[Any, list[str]] = (None, [])
+
+
+def _dict_row(cursor: sqlite3.Cursor, row: tuple[Any, ...]) -> dict[str, Any]:
+    # Build plain dicts straight from the tuple, matching RealDictCursor in
+    # Postgres mode, instead of creating a sqlite3.Row and copying it.
+    # description is one tuple per result set, so its names are listed once
+    # per statement rather than once per row.
+    global _ROW_NAMES
+    description, names = _ROW_NAMES
+    if description is not cursor.description:
+        names = [d[0] for d in cursor.description]
+        _ROW_NAMES = (cursor.description, names)
+    return dict(zip(names, row))
+
+
+def _apply_sqlite_pragmas(conn) -> None:
+    """
+    Tune SQLite for the ingest write path: WAL lets readers run alongside the
+    writer and synchronous=NORMAL only fsyncs at checkpoints. Reads go through
+    a memory map of up to 256 MB instead of read() calls into the page cache.
+    """
+    if str(SQLITE_PATH) != ":memory:":
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+
 # =========================
 # SCHEMA (SQLite)
 # =========================
@@ -205,10 +313,81 @@ CREATE TABLE IF NOT EXISTS users (
     error TEXT
 );
 
+CREATE TABLE IF NOT EXISTS etags (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT
+);
+
 CREATE INDEX IF NOT EXISTS idx_repos_user_pushed
 ON repos(user_name, pushed_at DESC);
 """
 
+# Secondary indexes on commits. Kept separate so a bulk load into an empty
+# table can drop them and build them once at the end.
+COMMIT_INDEX_SQL = """
+-- Covers get_commit_timeline: newest-first per repo, answered from the index alone.
+CREATE INDEX IF NOT EXISTS idx_commits_recent
+ON commits(
+    user_name, repo, authored_at DESC,
+    sha, message, author_name, author_login, files_changed, additions, deletions
+);
+"""
+
+# Full-text index over README/description, kept in sync with `repos` by
+# triggers. External-content table: text is stored once, in `repos`.
+# It is keyed on the implicit rowid of `repos`, which has a composite primary
+# key, so VACUUM may renumber those rowids: compact the file with vacuum()
+# below (scripts/vacuum_db.py), which rebuilds the index afterwards, never
+# with a bare VACUUM.
+README_FTS_SQL = """
+CREATE VIRTUAL TABLE readme_fts USING fts5(
+    readme_text, description,
+    content='repos', content_rowid='rowid',
+    tokenize='porter unicode61'
+);
+
+CREATE TRIGGER IF NOT EXISTS repos_fts_ai AFTER INSERT ON repos BEGIN
+    INSERT INTO readme_fts(rowid, readme_text, description)
+    VALUES (new.rowid, new.readme_text, new.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS repos_fts_ad AFTER DELETE ON repos BEGIN
+    INSERT INTO readme_fts(readme_fts, rowid, readme_text, description)
+    VALUES ('delete', old.rowid, old.readme_text, old.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS repos_fts_au AFTER UPDATE ON repos BEGIN
+    INSERT INTO readme_fts(readme_fts, rowid, readme_text, description)
+    VALUES ('delete', old.rowid, old.readme_text, old.description);
+    INSERT INTO readme_fts(rowid, readme_text, description)
+    VALUES (new.rowid, new.readme_text, new.description);
+END;
+
+INSERT INTO readme_fts(readme_fts) VALUES ('rebuild');
+"""
+
+
+def _init_readme_fts(conn) -> None:
+    """
+    Create the FTS5 index on first use and backfill it from existing rows.
+    Skipped (search falls back to LIKE) if SQLite was built without FTS5.
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='readme_fts'"
+    ).fetchone()
+    if exists:
+        return
+    try:
+        conn.executescript(README_FTS_SQL)
+    except sqlite3.OperationalError as e:
+        LOGGER.warning("FTS5 unavailable, README search will use LIKE: %s", e)
+
+
+# SQLite files whose schema this process has already created/verified.
+_SCHEMA_READY: set[str] = set()
+
+
 def init_schema(conn):
     if get_db_mode() == "postgres":
         # Postgres schema is managed externally (tables already exist)
@@ -221,23 +400,141 @@ def init_schema(conn):
             LOGGER.warning(f"Postgres connection check failed: {e}")
         return
 
+    db_key = str(SQLITE_PATH)
+    if db_key in _SCHEMA_READY:
+        return
+
     LOGGER.info("Initializing SQLite schema...")
+    new_indexes = not conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_commits_recent'"
+    ).fetchone()
     conn.executescript(SCHEMA_SQL)
+    conn.executescript(COMMIT_INDEX_SQL)
+    _init_readme_fts(conn)
+    if new_indexes:
+        # Give the query planner statistics for the freshly created indexes.
+        conn.execute("ANALYZE")
     conn.commit()
+    if db_key != ":memory:":
+        # An in-memory database is new on every connection.
+        _SCHEMA_READY.add(db_key)
+
+
+def drop_commit_indexes(conn) -> bool:
+    """
+    Drop the secondary commit indexes before a bulk load into an empty
+    `commits` table. Returns True if they were dropped, in which case the
+    caller must call create_commit_indexes() when the load is done.
+    """
+    if get_db_mode() != "sqlite":
+        return False
+    if conn.execute("SELECT 1 FROM commits LIMIT 1").fetchone():
+        # Rebuilding over existing rows costs more than maintaining the index.
+        return False
+    conn.execute("DROP INDEX IF EXISTS idx_commits_recent")
+    conn.commit()
+    return True
+
+
+def create_commit_indexes(conn) -> None:
+    conn.executescript(COMMIT_INDEX_SQL)
+    conn.execute("ANALYZE")
+    conn.commit()
+
+
+def vacuum(conn) -> None:
+    """
+    VACUUM the SQLite file, then rebuild readme_fts against the (possibly
+    renumbered) rowids of `repos`. Must not be called inside a transaction.
+    """
+    if get_db_mode() != "sqlite":
+        return
+    conn.execute("VACUUM")
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='readme_fts'").fetchone():
+        with conn:
+            conn.execute("INSERT INTO readme_fts(readme_fts) VALUES ('rebuild')")
 
 # =========================
 # DB HELPERS
 # =========================
 
 def upsert(conn, sql: str, params: tuple[Any, ...]) -> None:
+    """
+    Execute a single write. Does not commit: callers own the transaction
+    (e.g. ``with conn:``) so bulk writes pay for one commit, not one per row.
+    """
     if get_db_mode() == "postgres":
         with conn.cursor() as cur:
             cur.execute(sql, params)
-        conn.commit()
     else:
         sql = adapt_sql(sql)
         conn.execute(sql, params)
-        conn.commit()
+
+
+_VALUES_ROW_RE = re.compile(r"\bVALUES\s*(\(\s*%s(?:\s*,\s*%s)*\s*\))", re.IGNORECASE)
+
+
+@lru_cache(maxsize=64)
+def _values_split(sql: str) -> Optional[tuple[str, str]]:
+    """
+    Split ``INSERT ... VALUES (%s, ...) ...`` into the ``VALUES %s`` statement
+    and row template execute_values() expects, or None if it doesn't fit.
+    """
+    m = _VALUES_ROW_RE.search(sql)
+    if not m:
+        return None
+    statement = sql[:m.start(1)] + "%s" + sql[m.end(1):]
+    if statement.count("%s") != 1:
+        return None
+    return statement, m.group(1)
+
+
+def upsert_many(conn, sql: str, rows: list[tuple[Any, ...]]) -> None:
+    """
+    Execute the same write for every row in one executemany() call.
+    Like upsert(), the caller owns the transaction.
+
+    In Postgres mode INSERTs are sent as multi-row ``VALUES`` pages, so rows
+    in one call must not repeat a conflict key (ON CONFLICT DO UPDATE cannot
+    touch the same row twice in one statement).
+    """
+    if not rows:
+        return
+    if get_db_mode() == "postgres":
+        split = _values_split(sql)
+        with conn.cursor() as cur:
+            if split:
+                # One INSERT per 500 rows instead of one statement per row.
+                execute_values(cur, split[0], rows, template=split[1], page_size=500)
+            else:
+                execute_batch(cur, sql, rows, page_size=500)
+    else:
+        conn.executemany(adapt_sql(sql), rows)
+
+
+@contextmanager
+def savepoint(conn, name: str):
+    """
+    Run a block of writes inside SAVEPOINT `name`, within the caller's
+    transaction. On error only that block is rolled back and the exception
+    re-raised; in Postgres this also keeps the outer transaction usable
+    instead of aborting every statement after the failed one.
+    """
+    def run(sql: str) -> None:
+        if get_db_mode() == "postgres":
+            with conn.cursor() as cur:
+                cur.execute(sql)
+        else:
+            conn.execute(sql)
+
+    run(f"SAVEPOINT {name}")
+    try:
+        yield
+    except Exception:
+        run(f"ROLLBACK TO SAVEPOINT {name}")
+        run(f"RELEASE SAVEPOINT {name}")
+        raise
+    run(f"RELEASE SAVEPOINT {name}")
 
 
 def fetchall(conn, sql: str, params: tuple[Any, ...] = ()) -> list[dict[str, Any]]:
@@ -246,8 +543,7 @@ def fetchall(conn, sql: str, params: tuple[Any, ...] = ()) -> list[dict[str, Any
             cur.execute(sql, params)
             return cur.fetchall()
     else:
-        cur = conn.execute(sql, params)
-        return [dict(r) for r in cur.fetchall()]
+        return conn.execute(sql, params).fetchall()
 
 
 def fetchone(conn, sql: str, params: tuple[Any, ...] = ()) -> Optional[dict[str, Any]]:
@@ -256,6 +552,4 @@ def fetchone(conn, sql: str, params: tuple[Any, ...] = ()) -> Optional[dict[str,
             cur.execute(sql, params)
             return cur.fetchone()
     else:
-        cur = conn.execute(sql, params)
-        row = cur.fetchone()
-        return dict(row) if row else None
\ No newline at end of file
+        return conn.execute(sql, params).fetchone()
\ No newline at end of file
@@ -1,23 +1,150 @@
 from __future__ import annotations
-import json
+import asyncio
 import argparse
-import base64
 import logging
+import os
+import re
+import time
 from datetime import datetime, timezone
 from typing import Any, Dict, Optional
 import yaml
 from pathlib import Path
+from urllib.parse import urlencode
 from dotenv import load_dotenv
-from pathlib import Path
 
 load_dotenv(Path(__file__).parent / "secrets.env", override=False)
 import httpx
-from dotenv import load_dotenv
 
-from .common import LOGGER, connect, fetchall, fetchone, init_schema, upsert
+from .common import (
+    LOGGER,
+    connect,
+    create_commit_indexes,
+    drop_commit_indexes,
+    fetchall,
+    fetchone,
+    get_db_mode,
+    init_schema,
+    json_dumps,
+    json_loads,
+    savepoint,
+    upsert,
+    upsert_many,
+)
 from .user_service import upsert_user
 
 GITHUB_API = "https://api.github.com"
+GITHUB_GRAPHQL = f"{GITHUB_API}/graphql"
+
+# Max repos ingested concurrently.
+REPO_CONCURRENCY = 6
+
+# Max in-flight per-commit detail requests per repo.
+COMMIT_DETAILS_CONCURRENCY = 8
+
+# Rate-limited requests are retried after GitHub's advised wait, unless that
+# wait is longer than this (seconds); then the error response is returned.
+RATE_LIMIT_MAX_WAIT = 90.0
+RATE_LIMIT_RETRIES = 3
+
+# Stored READMEs keep the head and a short tail; the middle of very long
+# READMEs adds pages to every scan without helping search or summaries.
+README_HEAD_CHARS = 28 * 1024
+README_TAIL_CHARS = 4 * 1024
+
+UPSERT_REPO_SQL = """
+INSERT INTO repos(
+  user_name, repo, default_branch, description, language, html_url,
+  readme_text, last_ingested_at, pushed_at, created_at, updated_at,
+  stargazers_count, forks_count, watchers_count,
+  open_issues_count, size, topics, license_name,
+  is_archived, is_fork
+)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+ON CONFLICT(user_name, repo) DO UPDATE SET
+  default_branch=excluded.default_branch,
+  description=excluded.description,
+  language=excluded.language,
+  html_url=excluded.html_url,
+  readme_text=COALESCE(excluded.readme_text, repos.readme_text),
+  last_ingested_at=excluded.last_ingested_at,
+  pushed_at=excluded.pushed_at,
+  created_at=excluded.created_at,
+  updated_at=excluded.updated_at,
+  stargazers_count=excluded.stargazers_count,
+  forks_count=excluded.forks_count,
+  watchers_count=excluded.watchers_count,
+  open_issues_count=excluded.open_issues_count,
+  size=excluded.size,
+  topics=excluded.topics,
+  license_name=excluded.license_name,
+  is_archived=excluded.is_archived,
+  is_fork=excluded.is_fork
+"""
+
+UPSERT_SIGNALS_SQL = """
+INSERT INTO repo_signals (
+  user_name, repo,
+  has_tests, has_github_actions, has_ci_config, has_lint_config,
+  has_precommit, has_dockerfile, has_docker_compose, has_makefile,
+  detected_test_framework, detected_ci,
+  has_code_of_conduct, has_contributing, has_license, has_security_policy,
+  has_issue_templates, has_pr_templates, has_changelog, has_docs,
+  organization_score, coding_standards_score, automation_score,
+  tech_stack, signals_json
+)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+ON CONFLICT(user_name, repo) DO UPDATE SET
+  has_tests=excluded.has_tests,
+  has_github_actions=excluded.has_github_actions,
+  has_ci_config=excluded.has_ci_config,
+  has_lint_config=excluded.has_lint_config,
+  has_precommit=excluded.has_precommit,
+  has_dockerfile=excluded.has_dockerfile,
+  has_docker_compose=excluded.has_docker_compose,
+  has_makefile=excluded.has_makefile,
+  detected_test_framework=excluded.detected_test_framework,
+  detected_ci=excluded.detected_ci,
+  has_code_of_conduct=excluded.has_code_of_conduct,
+  has_contributing=excluded.has_contributing,
+  has_license=excluded.has_license,
+  has_security_policy=excluded.has_security_policy,
+  has_issue_templates=excluded.has_issue_templates,
+  has_pr_templates=excluded.has_pr_templates,
+  has_changelog=excluded.has_changelog,
+  has_docs=excluded.has_docs,
+  organization_score=excluded.organization_score,
+  coding_standards_score=excluded.coding_standards_score,
+  automation_score=excluded.automation_score,
+  tech_stack=excluded.tech_stack,
+  signals_json=excluded.signals_json
+"""
+
+UPSERT_TEXT_FILE_SQL = """
+INSERT INTO repo_text_files (
+    user_name, repo, path, extension, content
+)
+VALUES (%s, %s, %s, %s, %s)
+ON CONFLICT (user_name, repo, path) DO UPDATE SET
+    extension = EXCLUDED.extension,
+    content = EXCLUDED.content
+"""
+
+UPSERT_COMMIT_SQL = """
+INSERT INTO commits (
+   user_name, repo, sha, authored_at, message,
+   author_name, author_login, files_changed,
+   additions, deletions
+)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+ON CONFLICT (user_name, repo, sha) DO UPDATE SET
+   authored_at = EXCLUDED.authored_at,
+   message = EXCLUDED.message,
+   author_name = EXCLUDED.author_name,
+   author_login = EXCLUDED.author_login,
+   files_changed = COALESCE(EXCLUDED.files_changed, commits.files_changed),
+   additions = COALESCE(EXCLUDED.additions, commits.additions),
+   deletions = COALESCE(EXCLUDED.deletions, commits.deletions)
+"""
 
 
 def load_config() -> dict:
@@ -35,118 +162,367 @@ def _headers(token: str) -> dict[str, str]:
     }
 
 
-async def _get_json(client: httpx.AsyncClient, url: str, token: str, params: Optional[dict[str, Any]] = None) -> Any:
-    resp = await client.get(url, headers=_headers(token), params=params, timeout=60.0)
-    resp.raise_for_status()
-    return resp.json()
-
+# Returned by conditional GETs when GitHub answers 304 Not Modified.
+NOT_MODIFIED = object()
 
-async def _get_text(client: httpx.AsyncClient, url: str, token: str) -> str:
-    resp = await client.get(url, headers=_headers(token), timeout=60.0)
-    resp.raise_for_status()
-    return resp.text
+UPSERT_ETAG_SQL = """
+INSERT INTO etags (url, etag, last_modified)
+VALUES (%s, %s, %s)
+ON CONFLICT (url) DO UPDATE SET
+    etag = EXCLUDED.etag,
+    last_modified = EXCLUDED.last_modified
+"""
 
 
-async def list_repos(user_name: str, token: str) -> list[dict[str, Any]]:
-    async with httpx.AsyncClient() as client:
-        # Use /users/{user_name}/repos (public) or /user/repos when token belongs to the user.
-        # Here we use /users to allow analyzing any public profile with a token for rate limits.
-        repos = []
-        page = 1
-        while True:
-            data = await _get_json(
-                client,
-                f"{GITHUB_API}/users/{user_name}/repos",
-                token,
-                params={"per_page": 100, "page": page, "sort": "updated"},
-            )
-            if not data:
-                break
-            repos.extend(data)
-            page += 1
-        return repos
+class ETagCache:
+    """
+    Validators (ETag / Last-Modified) per GitHub URL, used to send conditional
+    requests so unchanged resources come back as 304 with no body.
 
+    New validators are staged by remember() and only written by flush(), so
+    they are committed in the same transaction as the data they describe.
+    """
 
-async def fetch_readme(user_name: str, repo: str, token: str, default_branch: str) -> str:
-    async with httpx.AsyncClient() as client:
-        # GitHub README API returns base64 content.
+    def __init__(self, conn):
+        self._validators: dict[str, tuple[Optional[str], Optional[str]]] = {}
+        self._pending: dict[str, tuple[Optional[str], Optional[str]]] = {}
+        self.enabled = True
         try:
-            data = await _get_json(client, f"{GITHUB_API}/repos/{user_name}/{repo}/readme", token)
-            content_b64 = data.get("content", "")
-            if content_b64:
-                return base64.b64decode(content_b64).decode("utf-8", errors="replace")
-        except Exception:
-            pass
-        return ""
+            rows = fetchall(conn, "SELECT url, etag, last_modified FROM etags")
+        except Exception as e:
+            # Postgres schema is managed externally and may not have the table yet.
+            LOGGER.warning("ETag cache unavailable, using unconditional requests: %s", e)
+            if get_db_mode() == "postgres":
+                conn.rollback()
+            self.enabled = False
+            rows = []
+        for row in rows:
+            self._validators[row["url"]] = (row["etag"], row["last_modified"])
+
+    @staticmethod
+    def _key(url: str, params: Optional[dict[str, Any]]) -> str:
+        if not params:
+            return url
+        return f"{url}?{urlencode(sorted(params.items()))}"
+
+    def request_headers(self, url: str, params: Optional[dict[str, Any]] = None) -> Optional[dict[str, str]]:
+        if not self.enabled:
+            return None
+        etag, last_modified = self._validators.get(self._key(url, params), (None, None))
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers or None
+
+    def remember(self, url: str, params: Optional[dict[str, Any]], resp: httpx.Response) -> None:
+        etag = resp.headers.get("ETag")
+        last_modified = resp.headers.get("Last-Modified")
+        if self.enabled and (etag or last_modified):
+            key = self._key(url, params)
+            self._validators[key] = self._pending[key] = (etag, last_modified)
+
+    def _take_pending(self, prefix: str) -> dict[str, tuple[Optional[str], Optional[str]]]:
+        taken = {url: v for url, v in self._pending.items() if url.startswith(prefix)}
+        for url in taken:
+            del self._pending[url]
+        return taken
+
+    def flush(self, conn, prefix: str = "") -> None:
+        """
+        Write staged validators whose URL starts with `prefix`; call inside the
+        caller's transaction. Repos ingested concurrently each flush their own.
+        """
+        taken = self._take_pending(prefix)
+        if taken:
+            upsert_many(conn, UPSERT_ETAG_SQL, [(url, e, lm) for url, (e, lm) in taken.items()])
+
+    def discard_pending(self, prefix: str = "") -> None:
+        """Drop staged validators (the data they describe was not stored)."""
+        for url in self._take_pending(prefix):
+            self._validators.pop(url, None)
+
+
+def _rate_limit_wait(resp: httpx.Response) -> Optional[float]:
+    """
+    Seconds GitHub asks us to wait before retrying, or None if `resp` is not
+    a rate-limit response. Secondary limits send Retry-After; an exhausted
+    primary quota sends X-RateLimit-Remaining: 0 and the reset epoch.
+    """
+    if resp.status_code not in (403, 429):
+        return None
+    retry_after = resp.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            return None
+    if resp.headers.get("X-RateLimit-Remaining") == "0":
+        try:
+            return max(float(resp.headers.get("X-RateLimit-Reset", "")) - time.time(), 0.0) + 1.0
+        except ValueError:
+            return None
+    return None
 
 
-async def list_tree(user_name: str, repo: str, token: str, default_branch: str) -> list[str]:
+class _RateLimitTransport(httpx.AsyncBaseTransport):
     """
-    Shallow repo signals: we fetch the git tree (recursive=1) and inspect file paths.
+    Waits out GitHub rate limits and retries, so a burst that trips the
+    secondary limit costs one short pause instead of failing the repo.
+    Applies to every request made through the client, REST and GraphQL.
     """
-    async with httpx.AsyncClient() as client:
-        ref = await _get_json(client, f"{GITHUB_API}/repos/{user_name}/{repo}/git/refs/heads/{default_branch}", token)
-        sha = ref["object"]["sha"]
-        commit = await _get_json(client, f"{GITHUB_API}/repos/{user_name}/{repo}/git/commits/{sha}", token)
-        tree_sha = commit["tree"]["sha"]
-        tree = await _get_json(
+
+    def __init__(self, inner: httpx.AsyncBaseTransport):
+        self._inner = inner
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        for _ in range(RATE_LIMIT_RETRIES):
+            resp = await self._inner.handle_async_request(request)
+            wait = _rate_limit_wait(resp)
+            if wait is None or wait > RATE_LIMIT_MAX_WAIT:
+                return resp
+            await resp.aclose()
+            LOGGER.warning("GitHub rate limit on %s, retrying in %.0fs", request.url, wait)
+            await asyncio.sleep(wait)
+        return await self._inner.handle_async_request(request)
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+
+def _client(token: str) -> httpx.AsyncClient:
+    """
+    One client per ingest run: auth headers are set once and TCP/TLS
+    connections are pooled across every GitHub request.
+    """
+    return httpx.AsyncClient(
+        headers=_headers(token),
+        timeout=60.0,
+        transport=_RateLimitTransport(
+            httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=32, max_keepalive_connections=16))
+        ),
+    )
+
+
+async def _get_json(
+    client: httpx.AsyncClient,
+    url: str,
+    params: Optional[dict[str, Any]] = None,
+    etags: Optional[ETagCache] = None,
+) -> Any:
+    """
+    GET a JSON resource. When an ETagCache is given the request is conditional
+    and NOT_MODIFIED is returned on 304 (no body, no rate-limit cost).
+    """
+    headers = etags.request_headers(url, params) if etags else None
+    resp = await client.get(url, params=params, headers=headers)
+    if resp.status_code == 304:
+        return NOT_MODIFIED
+    resp.raise_for_status()
+    if etags:
+        etags.remember(url, params, resp)
+    return json_loads(resp.content)
+
+
+async def _get_text(client: httpx.AsyncClient, url: str) -> str:
+    resp = await client.get(url)
+    resp.raise_for_status()
+    return resp.text
+
+
+async def list_repos(client: httpx.AsyncClient, user_name: str) -> list[dict[str, Any]]:
+    # Use /users/{user_name}/repos (public) or /user/repos when token belongs to the user.
+    # Here we use /users to allow analyzing any public profile with a token for rate limits.
+    repos = []
+    page = 1
+    while True:
+        data = await _get_json(
             client,
-            f"{GITHUB_API}/repos/{user_name}/{repo}/git/trees/{tree_sha}",
-            token,
-            params={"recursive": "1"},
+            f"{GITHUB_API}/users/{user_name}/repos",
+            params={"per_page": 100, "page": page, "sort": "updated"},
         )
-        paths = [t["path"] for t in tree.get("tree", []) if "path" in t]
-        return paths
+        if not data:
+            break
+        repos.extend(data)
+        page += 1
+    return repos
+
+
+async def fetch_readme(
+    client: httpx.AsyncClient,
+    user_name: str,
+    repo: str,
+    default_branch: str,
+    etags: Optional[ETagCache] = None,
+) -> Optional[str]:
+    # Ask for the raw media type so GitHub returns the file body directly
+    # instead of JSON with base64-encoded content.
+    url = f"{GITHUB_API}/repos/{user_name}/{repo}/readme"
+    headers = {"Accept": "application/vnd.github.raw"}
+    if etags:
+        headers.update(etags.request_headers(url, None) or {})
+    try:
+        resp = await client.get(url, headers=headers)
+        if resp.status_code == 304:
+            return None
+        resp.raise_for_status()
+        if etags:
+            etags.remember(url, None, resp)
+        return resp.text
+    except Exception:
+        pass
+    return ""
 
 
-def detect_signals(paths: list[str]) -> dict[str, Any]:
-    lower = [p.lower() for p in paths]
+def clip_readme(text: Optional[str]) -> Optional[str]:
+    if not text or len(text) <= README_HEAD_CHARS + README_TAIL_CHARS:
+        return text
+    return text[:README_HEAD_CHARS] + "\n\n[...]\n\n" + text[-README_TAIL_CHARS:]
 
-    def has_any(prefixes: list[str]) -> bool:
-        return any(any(p.startswith(pref) for pref in prefixes) for p in lower)
 
-    # Test detection
-    has_tests = any(
-        p.startswith(("test/", "tests/", "__tests__/", "spec/")) or
-        p.endswith(("_test.py", ".spec.ts", ".test.ts", ".test.js", ".test.py", "_spec.rb", ".spec.rb"))
-        for p in lower
+async def list_tree(
+    client: httpx.AsyncClient,
+    user_name: str,
+    repo: str,
+    default_branch: str,
+    etags: Optional[ETagCache] = None,
+) -> Optional[list[str]]:
+    """
+    Shallow repo signals: we fetch the git tree (recursive=1) and inspect file paths.
+    Returns None when the branch ref is unchanged since the last run.
+    """
+    ref = await _get_json(
+        client, f"{GITHUB_API}/repos/{user_name}/{repo}/git/refs/heads/{default_branch}", etags=etags
     )
+    if ref is NOT_MODIFIED:
+        return None
+    sha = ref["object"]["sha"]
+    commit = await _get_json(client, f"{GITHUB_API}/repos/{user_name}/{repo}/git/commits/{sha}")
+    tree_sha = commit["tree"]["sha"]
+    tree = await _get_json(
+        client,
+        f"{GITHUB_API}/repos/{user_name}/{repo}/git/trees/{tree_sha}",
+        params={"recursive": "1"},
+    )
+    paths = [t["path"] for t in tree.get("tree", []) if "path" in t]
+    return paths
+
+
+_TEST_FRAMEWORK_RE = re.compile(
+    r"(?P<pytest>pytest\.ini|conftest\.py)\Z"
+    r"|(?P<jest>jest\.config\.(?:js|ts|json))\Z"
+    r"|(?P<vitest>vitest\.config\.[jt]s)\Z"
+    r"|(?P<mocha>mocha\.opts|\.mocharc\.json|\.mocharc\.js)\Z"
+    r"|(?P<rspec>spec_helper\.rb|test_helper\.rb)\Z"
+)
+
+# Cheap str.endswith gate so the regex only runs on candidate file names.
+_TEST_FRAMEWORK_SUFFIXES = (
+    "pytest.ini", "conftest.py",
+    "jest.config.js", "jest.config.ts", "jest.config.json",
+    "vitest.config.js", "vitest.config.ts",
+    "mocha.opts", ".mocharc.json", ".mocharc.js",
+    "spec_helper.rb", "test_helper.rb",
+)
+
+# Priority order when several test frameworks are present.
+_TEST_FRAMEWORK_ORDER = ("pytest", "jest", "vitest", "mocha", "rspec")
+
+
+# Path patterns for detect_signals(), built once. All matched against lowercased paths;
+# str.startswith/endswith take tuples natively.
+_TEST_DIR_PREFIXES = ("test/", "tests/", "__tests__/", "spec/")
+_TEST_FILE_SUFFIXES = ("_test.py", ".spec.ts", ".test.ts", ".test.js", ".test.py", "_spec.rb", ".spec.rb")
+_CI_PREFIXES = (".circleci/", ".gitlab-ci", "azure-pipelines", "jenkinsfile")
+_LINT_FILES = frozenset({
+    ".ruff.toml", "ruff.toml", "pyproject.toml", ".flake8", "setup.cfg", ".pylintrc",
+    ".eslintrc", ".eslintrc.json", ".eslintrc.js", ".eslintrc.cjs", ".eslintrc.yaml",
+    ".prettierrc", ".prettierrc.json", ".prettierrc.js", ".prettierrc.yaml",
+    ".stylelintrc", ".editorconfig", ".clang-format",
+})
+_LINT_SUFFIXES = (".eslintrc.js", ".prettierrc.json")
+_DOCKER_COMPOSE_SUFFIXES = ("docker-compose.yml", "docker-compose.yaml")
+_CODE_OF_CONDUCT_FILES = frozenset({"code_of_conduct.md", "code-of-conduct.md", ".github/code_of_conduct.md"})
+_CONTRIBUTING_FILES = frozenset({"contributing.md", "contributing.rst", ".github/contributing.md"})
+_SECURITY_FILES = frozenset({".github/security.md", "security.md", "security.rst"})
+_LICENSE_PREFIXES = ("license", "licence")
+_CHANGELOG_PREFIXES = ("changelog", "changes", "history")
+_DOCS_PREFIXES = ("docs/", "documentation/")
 
-    # CI/CD detection
-    has_actions = any(p.startswith(".github/workflows/") for p in lower)
-    has_ci = has_actions or any(
-        p.startswith((".circleci/", ".gitlab-ci", "azure-pipelines", "jenkinsfile")) for p in lower)
-
-    # Linting and code quality
-    lint_files = {
-        ".ruff.toml", "ruff.toml", "pyproject.toml", ".flake8", "setup.cfg", ".pylintrc",
-        ".eslintrc", ".eslintrc.json", ".eslintrc.js", ".eslintrc.cjs", ".eslintrc.yaml",
-        ".prettierrc", ".prettierrc.json", ".prettierrc.js", ".prettierrc.yaml",
-        ".stylelintrc", ".editorconfig", ".clang-format",
-    }
-    has_lint = any(p in lint_files or p.endswith(".eslintrc.js") or p.endswith(".prettierrc.json") for p in lower)
-
-    # Automation and tooling
-    has_precommit = any(p == ".pre-commit-config.yaml" for p in lower)
-    has_dockerfile = any(p.endswith("dockerfile") or p == "dockerfile" for p in lower)
-    has_docker_compose = any(p.endswith("docker-compose.yml") or p.endswith("docker-compose.yaml") for p in lower)
-    has_makefile = any(p == "makefile" for p in lower)
-
-    # Documentation and organization
-    has_code_of_conduct = any(
-        p in ("code_of_conduct.md", "code-of-conduct.md", ".github/code_of_conduct.md") for p in lower)
-    has_contributing = any(p in ("contributing.md", "contributing.rst", ".github/contributing.md") for p in lower)
-    has_license = any(p.startswith("license") or p.startswith("licence") for p in lower)
-    has_security_policy = any(p in (".github/security.md", "security.md", "security.rst") for p in lower)
-    has_issue_templates = any(p.startswith(".github/issue_template") or ".github/ISSUE_TEMPLATE" in p for p in lower)
-    has_pr_templates = any(
-        p.startswith(".github/pull_request_template") or ".github/PULL_REQUEST_TEMPLATE" in p for p in lower)
-    has_changelog = any(p.startswith(("changelog", "changes", "history")) for p in lower)
-    has_docs = any(p.startswith(("docs/", "documentation/")) for p in lower)
-
-    # Tech stack detection (from file extensions and configs)
+
+def detect_signals(paths: list[str]) -> dict[str, Any]:
+    has_tests = has_actions = has_other_ci = has_lint = False
+    has_precommit = has_dockerfile = has_docker_compose = has_makefile = False
+    has_code_of_conduct = has_contributing = has_license = has_security_policy = False
+    has_issue_templates = has_pr_templates = has_changelog = has_docs = has_readme = False
+    has_circleci = has_gitlab_ci = has_azure = has_jenkins = has_travis = False
+    test_frameworks: set[str] = set()
     tech_stack = set()
-    for p in lower:
+
+    # Single pass: lowercase each path once and set every flag it can affect.
+    for p in paths:
+        p = p.lower()
+
+        # Test detection
+        if not has_tests and (p.startswith(_TEST_DIR_PREFIXES) or p.endswith(_TEST_FILE_SUFFIXES)):
+            has_tests = True
+
+        # CI/CD detection
+        if p.startswith(".github/workflows/"):
+            has_actions = True
+        if p.startswith(_CI_PREFIXES):
+            has_other_ci = True
+            if p.startswith(".circleci/"):
+                has_circleci = True
+            elif p.startswith(".gitlab-ci"):
+                has_gitlab_ci = True
+        if "azure-pipelines" in p:
+            has_azure = True
+        if "jenkinsfile" in p:
+            has_jenkins = True
+        if "travis.yml" in p:
+            has_travis = True
+
+        # Linting and code quality
+        if p in _LINT_FILES or p.endswith(_LINT_SUFFIXES):
+            has_lint = True
+
+        # Automation and tooling
+        if p == ".pre-commit-config.yaml":
+            has_precommit = True
+        elif p == "makefile":
+            has_makefile = True
+        if p.endswith("dockerfile"):
+            has_dockerfile = True
+        elif p.endswith(_DOCKER_COMPOSE_SUFFIXES):
+            has_docker_compose = True
+
+        # Documentation and organization
+        if p in _CODE_OF_CONDUCT_FILES:
+            has_code_of_conduct = True
+        elif p in _CONTRIBUTING_FILES:
+            has_contributing = True
+        elif p in _SECURITY_FILES:
+            has_security_policy = True
+        if p.startswith(_LICENSE_PREFIXES):
+            has_license = True
+        if p.startswith(".github/issue_template"):
+            has_issue_templates = True
+        elif p.startswith(".github/pull_request_template"):
+            has_pr_templates = True
+        if p.startswith(_CHANGELOG_PREFIXES):
+            has_changelog = True
+        if p.startswith(_DOCS_PREFIXES):
+            has_docs = True
+        if p.startswith("readme"):
+            has_readme = True
+
+        # Test framework detection
+        if p.endswith(_TEST_FRAMEWORK_SUFFIXES):
+            test_frameworks.add(_TEST_FRAMEWORK_RE.search(p).lastgroup)
+
+        # Tech stack detection (from file extensions and configs)
         # ---------- Python ----------
         if (
                 p.endswith(".py")
@@ -250,39 +626,31 @@ def detect_signals(paths: list[str]) -> dict[str, Any]:
         elif ".github/workflows" in p:
             tech_stack.add("GitHub Actions")
 
+    has_ci = has_actions or has_other_ci
+
     # Test framework detection
-    detected_test_framework = None
-    if any(p.endswith("pytest.ini") or p.endswith("conftest.py") or p.endswith("pytest.ini") for p in lower):
-        detected_test_framework = "pytest"
-    elif any(p.endswith(("jest.config.js", "jest.config.ts", "jest.config.json")) for p in lower):
-        detected_test_framework = "jest"
-    elif any(p.endswith(("vitest.config.ts", "vitest.config.js")) for p in lower):
-        detected_test_framework = "vitest"
-    elif any(p.endswith(("mocha.opts", ".mocharc.json", ".mocharc.js")) for p in lower):
-        detected_test_framework = "mocha"
-    elif any(p.endswith(("spec_helper.rb", "test_helper.rb")) for p in lower):
-        detected_test_framework = "rspec"
+    detected_test_framework = next((f for f in _TEST_FRAMEWORK_ORDER if f in test_frameworks), None)
 
     # CI/CD detection
     detected_ci = None
     if has_actions:
         detected_ci = "github_actions"
-    elif any(p.startswith(".circleci/") for p in lower):
+    elif has_circleci:
         detected_ci = "circleci"
-    elif any(p.startswith(".gitlab-ci") for p in lower):
+    elif has_gitlab_ci:
         detected_ci = "gitlab_ci"
-    elif any("azure-pipelines" in p for p in lower):
+    elif has_azure:
         detected_ci = "azure_pipelines"
-    elif any("jenkinsfile" in p for p in lower):
+    elif has_jenkins:
         detected_ci = "jenkins"
-    elif any("travis.yml" in p for p in lower):
+    elif has_travis:
         detected_ci = "travis"
 
     # Calculate scores (0-100 scale)
     organization_items = [
         has_code_of_conduct, has_contributing, has_license, has_security_policy,
         has_issue_templates, has_pr_templates, has_changelog, has_docs,
-        has_readme := any(p.startswith("readme") for p in lower)
+        has_readme,
     ]
     organization_score = round((sum(organization_items) / len(organization_items)) * 100, 1)
 
@@ -322,44 +690,150 @@ def detect_signals(paths: list[str]) -> dict[str, Any]:
     }
 
 
-async def list_commits(user_name: str, repo: str, token: str, max_commits: int = 200) -> list[dict[str, Any]]:
+async def list_commits(
+    client: httpx.AsyncClient,
+    user_name: str,
+    repo: str,
+    max_commits: int = 200,
+    etags: Optional[ETagCache] = None,
+) -> Optional[list[dict[str, Any]]]:
+    """
+    Page through the commit list, newest first. Only the first page is
+    requested conditionally: if it is unchanged, no new commits exist and
+    None is returned.
+    """
     commits: list[dict[str, Any]] = []
     per_page = 100
     page = 1
-    async with httpx.AsyncClient() as client:
-        while len(commits) < max_commits:
-            batch = await _get_json(
-                client,
-                f"{GITHUB_API}/repos/{user_name}/{repo}/commits",
-                token,
-                params={"per_page": per_page, "page": page},
-            )
-            if not batch:
-                break
-            commits.extend(batch)
-            page += 1
-            if len(batch) < per_page:
-                break
+    while len(commits) < max_commits:
+        batch = await _get_json(
+            client,
+            f"{GITHUB_API}/repos/{user_name}/{repo}/commits",
+            params={"per_page": per_page, "page": page},
+            etags=etags if page == 1 else None,
+        )
+        if batch is NOT_MODIFIED:
+            return None
+        if not batch:
+            break
+        commits.extend(batch)
+        page += 1
+        if len(batch) < per_page:
+            break
     return commits[:max_commits]
 
 
-async def fetch_commit_details(user_name: str, repo: str, sha: str, token: str) -> dict[str, Any]:
-    async with httpx.AsyncClient() as client:
-        return await _get_json(client, f"{GITHUB_API}/repos/{user_name}/{repo}/commits/{sha}", token)
+# README + commit history in one round trip. The README is only requested on
+# the first page; later pages just walk the history cursor.
+REPO_SNAPSHOT_QUERY = """
+query($owner: String!, $name: String!, $first: Int!, $after: String, $withReadme: Boolean!) {
+  repository(owner: $owner, name: $name) {
+    readme: object(expression: "HEAD:README.md") @include(if: $withReadme) {
+      ... on Blob { text }
+    }
+    defaultBranchRef {
+      target {
+        ... on Commit {
+          history(first: $first, after: $after) {
+            pageInfo { hasNextPage endCursor }
+            nodes { oid authoredDate message author { name user { login } } }
+          }
+        }
+      }
+    }
+  }
+}
+"""
 
 
-async def fetch_file_content(user_name: str, repo: str, path: str, token: str, ref: str) -> str:
-    raw_url = f"https://raw.githubusercontent.com/{user_name}/{repo}/{ref}/{path}"
+async def execute_graphql(
+    client: httpx.AsyncClient, query: str, variables: dict[str, Any]
+) -> dict[str, Any]:
+    resp = await client.post(GITHUB_GRAPHQL, json={"query": query, "variables": variables})
+    resp.raise_for_status()
+    payload = json_loads(resp.content)
+    if payload.get("errors"):
+        raise RuntimeError(f"GraphQL error: {payload['errors'][0].get('message')}")
+    return payload["data"]
+
+
+async def fetch_repo_snapshot(
+    client: httpx.AsyncClient,
+    user_name: str,
+    repo: str,
+    max_commits: int = 200,
+) -> dict[str, Any]:
+    """
+    Fetch README.md text and commit history via GraphQL instead of separate
+    REST calls. Commits are returned in the REST list shape so the caller can
+    treat both sources the same. readme_text is None when there is no
+    top-level README.md.
+    """
+    readme_text: Optional[str] = None
+    commits: list[dict[str, Any]] = []
+    cursor: Optional[str] = None
+    first_page = True
+    while len(commits) < max_commits:
+        data = await execute_graphql(
+            client,
+            REPO_SNAPSHOT_QUERY,
+            {
+                "owner": user_name,
+                "name": repo,
+                "first": min(100, max_commits - len(commits)),
+                "after": cursor,
+                "withReadme": first_page,
+            },
+        )
+        repository = data.get("repository") or {}
+        if first_page:
+            readme_text = (repository.get("readme") or {}).get("text")
+            first_page = False
+
+        target = (repository.get("defaultBranchRef") or {}).get("target") or {}
+        history = target.get("history")
+        if not history:
+            break
+        for node in history["nodes"]:
+            author = node.get("author") or {}
+            commits.append(
+                {
+                    "sha": node["oid"],
+                    "commit": {
+                        "author": {"date": node.get("authoredDate"), "name": author.get("name")},
+                        "message": node.get("message"),
+                    },
+                    "author": author.get("user"),
+                }
+            )
+        page_info = history["pageInfo"]
+        if not page_info["hasNextPage"]:
+            break
+        cursor = page_info["endCursor"]
+
+    return {"readme_text": readme_text, "commits": commits[:max_commits]}
+
+
+async def _bounded(sem: asyncio.Semaphore, coro):
+    async with sem:
+        return await coro
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(raw_url, headers=_headers(token), timeout=60.0)
-        resp.raise_for_status()
-        return resp.text
 
+async def fetch_commit_details(client: httpx.AsyncClient, user_name: str, repo: str, sha: str) -> dict[str, Any]:
+    return await _get_json(client, f"{GITHUB_API}/repos/{user_name}/{repo}/commits/{sha}")
 
-async def repo_text_files(user_name: str, repo: str, token: str, default_branch: str):
-    paths = await list_tree(user_name, repo, token, default_branch)
 
+async def fetch_file_content(client: httpx.AsyncClient, user_name: str, repo: str, path: str, ref: str) -> str:
+    raw_url = f"https://raw.githubusercontent.com/{user_name}/{repo}/{ref}/{path}"
+    return await _get_text(client, raw_url)
+
+
+async def repo_text_files(client: httpx.AsyncClient, user_name: str, repo: str, default_branch: str, paths: list[str]):
+    """
+    Fetch the repo's text files. Returns (files, number of files that failed):
+    failures are skipped rather than raised, but the caller must know the set
+    is incomplete.
+    """
     target_exts = (".md", ".json", ".txt", ".toml")
 
     text_files = [
@@ -371,10 +845,11 @@ async def repo_text_files(user_name: str, repo: str, token: str, default_branch:
     LOGGER.info("Found %d text files in %s/%s", len(text_files), user_name, repo)
 
     results = []
+    failed = 0
 
     for path in text_files:
         try:
-            content = await fetch_file_content(user_name, repo, path, token, default_branch)
+            content = await fetch_file_content(client, user_name, repo, path, default_branch)
 
             results.append({
                 "path": path,
@@ -383,9 +858,10 @@ async def repo_text_files(user_name: str, repo: str, token: str, default_branch:
             })
 
         except Exception as e:
+            failed += 1
             LOGGER.warning("Failed to fetch %s in %s/%s: %s", path, user_name, repo, e)
 
-    return results
+    return results, failed
 
 
 def _iso(dt: Optional[str]) -> str:
@@ -394,237 +870,299 @@ def _iso(dt: Optional[str]) -> str:
     return dt
 
 
-async def ingest(user_name: str, token: str, max_commits: int) -> None:
-    conn = connect()
-    init_schema(conn)
+def _repo_row(user_name: str, r: dict[str, Any], readme_text: Optional[str]) -> tuple[Any, ...]:
+    # FIXED: TEXT fields - use None for null values
+    description = r.get("description") or None
+    language = r.get("language") or None
+    html_url = r.get("html_url") or None
+
+    # FIXED: Timestamp fields - use None for null values
+    pushed_at = r.get("pushed_at") or None
+    created_at = r.get("created_at") or None
+    updated_at = r.get("updated_at") or None
+
+    # Numeric fields with defaults
+    stargazers_count = r.get("stargazers_count", 0)
+    forks_count = r.get("forks_count", 0)
+    watchers_count = r.get("watchers_count", 0)
+    open_issues_count = r.get("open_issues_count", 0)
+    size = r.get("size", 0)
+
+    # FIXED: JSON fields - proper handling
+    topics = json_dumps(r.get("topics", []))
+
+    # FIXED: License handling - handle nested structure properly
+    license_obj = r.get("license")
+    if license_obj and license_obj.get("name"):
+        license_name = license_obj["name"]
+    else:
+        license_name = None
+
+    # FIXED: Boolean flags - PostgreSQL needs True/False, not 1/0
+    is_archived = bool(r.get("archived", False))
+    is_fork = bool(r.get("fork", False))
+
+    return (
+        user_name, r["name"], r.get("default_branch") or "main", description, language, html_url, readme_text,
+        datetime.now(timezone.utc).isoformat(),
+        pushed_at, created_at, updated_at,
+        stargazers_count, forks_count, watchers_count,
+        open_issues_count, size, topics, license_name,
+        is_archived, is_fork
+    )
 
-    # --- Mark user ingestion as started ---
-    upsert_user(user_name=user_name, status="in_progress", repo_count=0)
 
-    try:
-        repos = await list_repos(user_name, token)
-        repo_count = len(repos)
-
-        LOGGER.info("Found %d repos for user=%s", repo_count, user_name)
-
-        for r in repos:
-            repo = r["name"]
-            default_branch = r.get("default_branch") or "main"
-
-            # FIXED: TEXT fields - use None for null values
-            description = r.get("description") or None
-            language = r.get("language") or None
-            html_url = r.get("html_url") or None
-
-            # FIXED: Timestamp fields - use None for null values
-            pushed_at = r.get("pushed_at") or None
-            created_at = r.get("created_at") or None
-            updated_at = r.get("updated_at") or None
-
-            # Numeric fields with defaults
-            stargazers_count = r.get("stargazers_count", 0)
-            forks_count = r.get("forks_count", 0)
-            watchers_count = r.get("watchers_count", 0)
-            open_issues_count = r.get("open_issues_count", 0)
-            size = r.get("size", 0)
-
-            # FIXED: JSON fields - proper handling
-            topics = json.dumps(r.get("topics", []))
-
-            # FIXED: License handling - handle nested structure properly
-            license_obj = r.get("license")
-            if license_obj and license_obj.get("name"):
-                license_name = license_obj["name"]
-            else:
-                license_name = None
-
-            # FIXED: Boolean flags - PostgreSQL needs True/False, not 1/0
-            is_archived = bool(r.get("archived", False))
-            is_fork = bool(r.get("fork", False))
-
-            readme_text = await fetch_readme(user_name, repo, token, default_branch)
-
-            upsert(
-                conn,
-                """
-                INSERT INTO repos(
-                  user_name, repo, default_branch, description, language, html_url,
-                  readme_text, last_ingested_at, pushed_at, created_at, updated_at,
-                  stargazers_count, forks_count, watchers_count,
-                  open_issues_count, size, topics, license_name,
-                  is_archived, is_fork
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT(user_name, repo) DO UPDATE SET
-                  default_branch=excluded.default_branch,
-                  description=excluded.description,
-                  language=excluded.language,
-                  html_url=excluded.html_url,
-                  readme_text=excluded.readme_text,
-                  last_ingested_at=excluded.last_ingested_at,
-                  pushed_at=excluded.pushed_at,
-                  created_at=excluded.created_at,
-                  updated_at=excluded.updated_at,
-                  stargazers_count=excluded.stargazers_count,
-                  forks_count=excluded.forks_count,
-                  watchers_count=excluded.watchers_count,
-                  open_issues_count=excluded.open_issues_count,
-                  size=excluded.size,
-                  topics=excluded.topics,
-                  license_name=excluded.license_name,
-                  is_archived=excluded.is_archived,
-                  is_fork=excluded.is_fork
-                """,
-                (
-                    user_name, repo, default_branch, description, language, html_url, readme_text,
-                    datetime.now(timezone.utc).isoformat(),
-                    pushed_at, created_at, updated_at,
-                    stargazers_count, forks_count, watchers_count,
-                    open_issues_count, size, topics, license_name,
-                    is_archived, is_fork
-                ),
+def _signals_row(user_name: str, repo: str, sig: dict[str, Any]) -> tuple[Any, ...]:
+    return (
+        user_name, repo,
+        sig["has_tests"], sig["has_github_actions"], sig["has_ci_config"], sig["has_lint_config"],
+        sig["has_precommit"], sig["has_dockerfile"], sig.get("has_docker_compose", 0),
+        sig["has_makefile"],
+        sig["detected_test_framework"], sig["detected_ci"],
+        sig["has_code_of_conduct"], sig["has_contributing"], sig["has_license"],
+        sig["has_security_policy"], sig["has_issue_templates"], sig["has_pr_templates"],
+        sig["has_changelog"], sig["has_docs"],
+        sig["organization_score"], sig["coding_standards_score"], sig["automation_score"],
+        sig["tech_stack"], json_dumps(sig["signals_json"] or {}),
+    )
+
+
+def _commit_rows(
+    user_name: str,
+    repo: str,
+    commits: list[dict[str, Any]],
+    details_by_sha: dict[str, dict[str, Any]],
+) -> list[tuple[Any, ...]]:
+    commit_rows: list[tuple[Any, ...]] = []
+    seen: set[str] = set()
+    for c in commits:
+        sha = c["sha"]
+        if sha in seen:
+            # Pages can overlap if the branch moves mid-listing; one multi-row
+            # upsert may not carry the same key twice.
+            continue
+        seen.add(sha)
+        commit_obj = c.get("commit", {})
+
+        # FIXED: Use None for null values instead of json.dumps({})
+        authored_at = commit_obj.get("author", {}).get("date") or None
+        message = commit_obj.get("message") or None
+        author_name = commit_obj.get("author", {}).get("name") or None
+
+        # FIXED: Handle nested author object properly
+        author_details = c.get("author")
+        author_login = author_details.get("login") if author_details else None
+
+        # Stats stay NULL when details were not fetched; the upsert keeps
+        # any previously stored values in that case.
+        files_changed = additions = deletions = None
+        details = details_by_sha.get(sha)
+        if details is not None:
+            files_changed = len(details.get("files") or [])
+            additions = details.get("stats", {}).get("additions", 0)
+            deletions = details.get("stats", {}).get("deletions", 0)
+
+        commit_rows.append(
+            (
+                user_name, repo, sha, authored_at, message,
+                author_name, author_login,
+                files_changed, additions, deletions,
             )
+        )
+    return commit_rows
+
+
+async def _ingest_repo(
+    client: httpx.AsyncClient,
+    sem: asyncio.Semaphore,
+    conn,
+    etags: ETagCache,
+    user_name: str,
+    r: dict[str, Any],
+    max_commits: int,
+    commit_details_limit: int,
+    use_graphql: bool,
+) -> None:
+    """
+    Fetch everything for one repo, then write it in a single transaction.
 
-            # --- Signals ---
+    All awaits happen before the write block, so concurrent repos never
+    interleave statements on the shared connection: each repo's writes run
+    to completion on the event loop before another coroutine resumes.
+    """
+    repo = r["name"]
+    default_branch = r.get("default_branch") or "main"
+    repo_ok = True
+
+    async with sem:
+        # With GraphQL, README + commits come back in one request; REST is
+        # still used for READMEs not named README.md and as a fallback.
+        snapshot = None
+        if use_graphql:
             try:
-                paths = await list_tree(user_name, repo, token, default_branch)
+                snapshot = await fetch_repo_snapshot(client, user_name, repo, max_commits)
+            except Exception as e:
+                LOGGER.warning("GraphQL snapshot failed for %s/%s, using REST: %s", user_name, repo, e)
+
+        if snapshot is not None and snapshot["readme_text"] is not None:
+            readme_text = snapshot["readme_text"]
+        else:
+            # None means the README is unchanged since the last run (304).
+            readme_text = await fetch_readme(client, user_name, repo, default_branch, etags)
+        readme_text = clip_readme(readme_text)
+
+        # --- Signals ---
+        # The tree is fetched once and shared with text-file ingestion.
+        # None means the branch head is unchanged since the last run (304).
+        paths = None
+        sig = None
+        try:
+            paths = await list_tree(client, user_name, repo, default_branch, etags)
+            if paths is None:
+                LOGGER.info("Tree unchanged for %s/%s; skipping signals and text files", user_name, repo)
+            else:
                 sig = detect_signals(paths)
+        except Exception as e:
+            repo_ok = False
+            LOGGER.warning("Signals scan failed for %s/%s: %s", user_name, repo, e)
 
-                upsert(
-                    conn,
-                    """
-                    INSERT INTO repo_signals (
-                      user_name, repo,
-                      has_tests, has_github_actions, has_ci_config, has_lint_config,
-                      has_precommit, has_dockerfile, has_docker_compose, has_makefile,
-                      detected_test_framework, detected_ci,
-                      has_code_of_conduct, has_contributing, has_license, has_security_policy,
-                      has_issue_templates, has_pr_templates, has_changelog, has_docs,
-                      organization_score, coding_standards_score, automation_score,
-                      tech_stack, signals_json
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT(user_name, repo) DO UPDATE SET
-                      has_tests=excluded.has_tests,
-                      has_github_actions=excluded.has_github_actions,
-                      has_ci_config=excluded.has_ci_config,
-                      has_lint_config=excluded.has_lint_config,
-                      has_precommit=excluded.has_precommit,
-                      has_dockerfile=excluded.has_dockerfile,
-                      has_docker_compose=excluded.has_docker_compose,
-                      has_makefile=excluded.has_makefile,
-                      detected_test_framework=excluded.detected_test_framework,
-                      detected_ci=excluded.detected_ci,
-                      has_code_of_conduct=excluded.has_code_of_conduct,
-                      has_contributing=excluded.has_contributing,
-                      has_license=excluded.has_license,
-                      has_security_policy=excluded.has_security_policy,
-                      has_issue_templates=excluded.has_issue_templates,
-                      has_pr_templates=excluded.has_pr_templates,
-                      has_changelog=excluded.has_changelog,
-                      has_docs=excluded.has_docs,
-                      organization_score=excluded.organization_score,
-                      coding_standards_score=excluded.coding_standards_score,
-                      automation_score=excluded.automation_score,
-                      tech_stack=excluded.tech_stack,
-                      signals_json=excluded.signals_json
-                    """,
-                    (
-                        user_name, repo,
-                        sig["has_tests"], sig["has_github_actions"], sig["has_ci_config"], sig["has_lint_config"],
-                        sig["has_precommit"], sig["has_dockerfile"], sig.get("has_docker_compose", 0),
-                        sig["has_makefile"],
-                        sig["detected_test_framework"], sig["detected_ci"],
-                        sig["has_code_of_conduct"], sig["has_contributing"], sig["has_license"],
-                        sig["has_security_policy"], sig["has_issue_templates"], sig["has_pr_templates"],
-                        sig["has_changelog"], sig["has_docs"],
-                        sig["organization_score"], sig["coding_standards_score"], sig["automation_score"],
-                        sig["tech_stack"], json.dumps(sig["signals_json"] or {}),
-                    ),
-                )
+        # --- Repo Text Files Ingestion ---
+        files = []
+        try:
+            if paths is not None:
+                files, failed_files = await repo_text_files(client, user_name, repo, default_branch, paths)
+                if failed_files:
+                    # The tree's validator would make the next run skip the
+                    # missing files until the branch moves.
+                    repo_ok = False
+        except Exception as e:
+            repo_ok = False
+            LOGGER.warning("Text file ingestion failed for %s/%s: %s", user_name, repo, e)
 
+        # --- Commits ---
+        commits: list[dict[str, Any]] = []
+        details_by_sha: dict[str, dict[str, Any]] = {}
+        try:
+            if snapshot is not None:
+                commits = snapshot["commits"]
+            else:
+                commits = await list_commits(
+                    client, user_name, repo, max_commits=max_commits, etags=etags
+                )
+            if commits is None:
+                LOGGER.info("Commits unchanged for %s/%s; skipping", user_name, repo)
+                commits = []
+
+            # The list response already carries author/date/message. Per-commit
+            # details (files/additions/deletions) cost one request each, so they
+            # are only fetched for the newest `commit_details_limit` commits.
+            detailed = commits[:commit_details_limit]
+            details_sem = asyncio.Semaphore(COMMIT_DETAILS_CONCURRENCY)
+            all_details = await asyncio.gather(
+                *[
+                    _bounded(details_sem, fetch_commit_details(client, user_name, repo, c["sha"]))
+                    for c in detailed
+                ],
+                return_exceptions=True,
+            )
+            for c, details in zip(detailed, all_details):
+                if isinstance(details, BaseException):
+                    # Keep the commits-list validator from hiding this
+                    # commit's details from the next run.
+                    repo_ok = False
+                    LOGGER.warning(
+                        "Commit details failed for %s/%s@%s: %s", user_name, repo, c["sha"], details
+                    )
+                else:
+                    details_by_sha[c["sha"]] = details
+        except Exception as e:
+            repo_ok = False
+            commits = []
+            LOGGER.warning("Commit ingestion failed for %s/%s: %s", user_name, repo, e)
+
+    # One transaction per repo: SQLite commits (and fsyncs) once instead of per row.
+    # Each optional part runs in a savepoint, so its failure undoes only that
+    # part (a failed statement would otherwise abort the whole Postgres
+    # transaction and take the repo row down with it).
+    # No awaits below this point.
+    with conn:
+        upsert(conn, UPSERT_REPO_SQL, _repo_row(user_name, r, readme_text))
+
+        if sig is not None:
+            try:
+                with savepoint(conn, "repo_signals"):
+                    upsert(conn, UPSERT_SIGNALS_SQL, _signals_row(user_name, repo, sig))
             except Exception as e:
+                repo_ok = False
                 LOGGER.warning("Signals scan failed for %s/%s: %s", user_name, repo, e)
 
-            # --- Repo Text Files Ingestion ---
-            try:
-                files = await repo_text_files(user_name, repo, token, default_branch)
-
-                for f in files:
-                    upsert(
-                        conn,
-                        """
-                        INSERT INTO repo_text_files (
-                            user_name, repo, path, extension, content
-                        )
-                        VALUES (%s, %s, %s, %s, %s)
-                        ON CONFLICT (user_name, repo, path) DO UPDATE SET
-                            extension = EXCLUDED.extension,
-                            content = EXCLUDED.content
-                        """,
-                        (
-                            user_name,
-                            repo,
-                            f["path"],
-                            f["extension"],
-                            f["content"],
-                        ),
-                    )
+        try:
+            with savepoint(conn, "repo_text_files"):
+                upsert_many(
+                    conn,
+                    UPSERT_TEXT_FILE_SQL,
+                    [
+                        (user_name, repo, f["path"], f["extension"], f["content"])
+                        for f in files
+                    ],
+                )
+        except Exception as e:
+            repo_ok = False
+            LOGGER.warning("Text file ingestion failed for %s/%s: %s", user_name, repo, e)
 
+        try:
+            with savepoint(conn, "repo_commits"):
+                upsert_many(conn, UPSERT_COMMIT_SQL, _commit_rows(user_name, repo, commits, details_by_sha))
+        except Exception as e:
+            repo_ok = False
+            LOGGER.warning("Commit ingestion failed for %s/%s: %s", user_name, repo, e)
+
+        # Only trust new validators if everything they guard was stored.
+        repo_prefix = f"{GITHUB_API}/repos/{user_name}/{repo}/"
+        if repo_ok:
+            etags.flush(conn, repo_prefix)
+        else:
+            etags.discard_pending(repo_prefix)
+
+
+async def ingest(
+    user_name: str,
+    token: str,
+    max_commits: int,
+    commit_details_limit: int = 0,
+    use_graphql: bool = False,
+) -> None:
+    conn = connect()
+    init_schema(conn)
+    etags = ETagCache(conn)
+    # First load into an empty DB: build the commit indexes once at the end.
+    rebuild_indexes = drop_commit_indexes(conn)
 
-            except Exception as e:
-                LOGGER.warning("Text file ingestion failed for %s/%s: %s", user_name, repo, e)
+    # --- Mark user ingestion as started ---
+    upsert_user(user_name=user_name, status="in_progress", repo_count=0)
 
-            # --- Commits ---
-            try:
-                commits = await list_commits(user_name, repo, token, max_commits=max_commits)
-
-                for c in commits:
-                    sha = c["sha"]
-                    details = await fetch_commit_details(user_name, repo, sha, token)
-
-                    commit_obj = details.get("commit", {})
-
-                    # FIXED: Use None for null values instead of json.dumps({})
-                    authored_at = commit_obj.get("author", {}).get("date") or None
-                    message = commit_obj.get("message") or None
-                    author_name = commit_obj.get("author", {}).get("name") or None
-
-                    # FIXED: Handle nested author object properly
-                    author_details = details.get("author")
-                    author_login = author_details.get("login") if author_details else None
-
-                    files = details.get("files") or []
-                    additions = details.get("stats", {}).get("additions", 0)
-                    deletions = details.get("stats", {}).get("deletions", 0)
-
-                    upsert(
-                        conn,
-                        """
-                        INSERT INTO commits (
-                           user_name, repo, sha, authored_at, message,
-                           author_name, author_login, files_changed,
-                           additions, deletions
-                        )
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        ON CONFLICT (user_name, repo, sha) DO UPDATE SET
-                           authored_at = EXCLUDED.authored_at,
-                           message = EXCLUDED.message,
-                           author_name = EXCLUDED.author_name,
-                           author_login = EXCLUDED.author_login,
-                           files_changed = EXCLUDED.files_changed,
-                           additions = EXCLUDED.additions,
-                           deletions = EXCLUDED.deletions
-                        """,
-                        (
-                            user_name, repo, sha, authored_at, message,
-                            author_name, author_login,
-                            len(files), additions, deletions,
-                        ),
+    try:
+        async with _client(token) as client:
+            repos = await list_repos(client, user_name)
+            repo_count = len(repos)
+
+            LOGGER.info("Found %d repos for user=%s", repo_count, user_name)
+
+            sem = asyncio.Semaphore(REPO_CONCURRENCY)
+            results = await asyncio.gather(
+                *[
+                    _ingest_repo(
+                        client, sem, conn, etags, user_name, r,
+                        max_commits, commit_details_limit, use_graphql,
                     )
-
-            except Exception as e:
-                LOGGER.warning("Commit ingestion failed for %s/%s: %s", user_name, repo, e)
+                    for r in repos
+                ],
+                return_exceptions=True,
+            )
+            # Let every repo finish before failing the run on the first error.
+            for res in results:
+                if isinstance(res, BaseException):
+                    raise res
 
         # --- Mark user ingestion as successful ---
         upsert_user(
@@ -648,6 +1186,10 @@ async def ingest(user_name: str, token: str, max_commits: int) -> None:
         LOGGER.exception("User ingestion failed for %s", user_name)
         raise
 
+    finally:
+        if rebuild_indexes:
+            create_commit_indexes(conn)
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -666,21 +1208,23 @@ def main():
 
     user_name = config["github"]["user"]
     max_commits = config["ingestion"].get("max_commits_per_repo", 200)
+    commit_details_limit = 0
+    if config["ingestion"].get("fetch_commit_details", False):
+        commit_details_limit = config["ingestion"].get("commit_details_limit", max_commits)
+    use_graphql = config["ingestion"].get("use_graphql", False)
 
     data_dir = config.get("storage", {}).get("data_dir")
     if data_dir:
-        import os
         os.environ["GITHUB_MCP_DATA_DIR"] = os.path.expanduser(data_dir)
 
     # --- Resolve token ---
-    token = args.token or __import__("os").environ.get("GITHUB_TOKEN")
+    token = args.token or os.environ.get("GITHUB_TOKEN")
     if not token:
         raise SystemExit(
             "Missing GitHub token. Set GITHUB_TOKEN env var or pass --token."
         )
 
-    import asyncio
-    asyncio.run(ingest(user_name, token, max_commits))
+    asyncio.run(ingest(user_name, token, max_commits, commit_details_limit, use_graphql))
 
 
 if __name__ == "__main__":
@@ -1,21 +1,48 @@
 from __future__ import annotations
 
 import argparse
-import json
+import functools
+import threading
 from typing import Any, Optional
 
 from mcp.server.fastmcp import FastMCP
 
-from .common import LOGGER, connect, fetchall, fetchone, init_schema
+from .common import LOGGER, connect, fetchall, fetchone, get_db_mode, init_schema, json_loads
 
 # Initialize FastMCP server
 mcp = FastMCP("github_mcp")
 
 
-def _conn_for(user: str):
-    conn = connect()
-    init_schema(conn)
-    return conn
+# One connection per store, opened and schema-initialized on first use.
+# All users share the same database, so the key is the DB mode, not the user.
+_CONN_CACHE: dict[str, Any] = {}
+_CONN_LOCK = threading.Lock()
+
+
+def _conn():
+    key = get_db_mode()
+    with _CONN_LOCK:
+        conn = _CONN_CACHE.get(key)
+        if conn is None:
+            conn = connect()
+            init_schema(conn)
+            _CONN_CACHE[key] = conn
+        return conn
+
+
+def _db_tool(fn):
+    """
+    Register `fn` as an MCP tool whose reads share one transaction, ended when
+    the tool returns. The cached connection is long-lived: in Postgres mode a
+    transaction left open would sit "idle in transaction", and after one failed
+    query every later call would fail with "current transaction is aborted".
+    """
+    @functools.wraps(fn)
+    async def tool(*args, **kwargs):
+        with _conn():  # commit on success, roll back on error; stays open
+            return await fn(*args, **kwargs)
+
+    return mcp.tool()(tool)
 
 
 def _safe_int(v: Any, default: int = 0) -> int:
@@ -40,7 +67,7 @@ def _loads_json_list(v: Any) -> list[Any]:
         return v
     if isinstance(v, str):
         try:
-            out = json.loads(v)
+            out = json_loads(v)
             return out if isinstance(out, list) else []
         except Exception:
             return []
@@ -55,7 +82,7 @@ def _loads_json_obj(v: Any) -> dict[str, Any]:
         return v
     if isinstance(v, str):
         try:
-            out = json.loads(v)
+            out = json_loads(v)
             return out if isinstance(out, dict) else {}
         except Exception:
             return {}
@@ -82,14 +109,14 @@ def _normalize_repo_row(r: dict[str, Any]) -> dict[str, Any]:
 # Core Tools (Single-Repo / Listing)
 # ============================================================
 
-@mcp.tool()
+@_db_tool
 async def list_repos(user: str) -> list[dict[str, Any]]:
     """
     List repositories ingested for a GitHub user, ordered by most recently pushed first.
 
     Returns: list of repos with metadata.
     """
-    conn = _conn_for(user)
+    conn = _conn()
     rows = fetchall(
         conn,
         """
@@ -119,7 +146,7 @@ async def list_repos(user: str) -> list[dict[str, Any]]:
     return [_normalize_repo_row(r) for r in (rows or [])]
 
 
-@mcp.tool()
+@_db_tool
 async def get_repo_overview(user: str, repo: str) -> dict[str, Any]:
     """
     Get comprehensive repository information including metadata and engineering signals.
@@ -128,13 +155,39 @@ async def get_repo_overview(user: str, repo: str) -> dict[str, Any]:
       user: GitHub username
       repo: repository name
     """
-    conn = _conn_for(user)
+    conn = _conn()
 
-    r = fetchone(conn, "SELECT * FROM repos WHERE user_name=? AND repo=?", (user, repo))
+    r = fetchone(
+        conn,
+        """
+        SELECT
+          description, language, html_url, default_branch,
+          created_at, updated_at, pushed_at, last_ingested_at, readme_text,
+          stargazers_count, forks_count, watchers_count, open_issues_count,
+          size, topics, license_name, is_archived, is_fork
+        FROM repos
+        WHERE user_name=? AND repo=?
+        """,
+        (user, repo),
+    )
     if not r:
         return {"error": f"Repo not found in MCP store: {user}/{repo}. Run ingestion first."}
 
-    s = fetchone(conn, "SELECT * FROM repo_signals WHERE user_name=? AND repo=?", (user, repo)) or {}
+    s = fetchone(
+        conn,
+        """
+        SELECT
+          has_tests, has_github_actions, has_ci_config, has_lint_config,
+          has_precommit, has_dockerfile, has_docker_compose, has_makefile,
+          detected_test_framework, detected_ci,
+          has_code_of_conduct, has_contributing, has_license, has_security_policy,
+          has_issue_templates, has_pr_templates, has_changelog, has_docs,
+          organization_score, coding_standards_score, automation_score, tech_stack
+        FROM repo_signals
+        WHERE user_name=? AND repo=?
+        """,
+        (user, repo),
+    ) or {}
 
     topics = _loads_json_list(r.get("topics"))
 
@@ -214,7 +267,7 @@ async def get_repo_overview(user: str, repo: str) -> dict[str, Any]:
     return overview
 
 
-@mcp.tool()
+@_db_tool
 async def get_commit_timeline(user: str, repo: str, limit: int = 50) -> list[dict[str, Any]]:
     """
     Return commit timeline (most recent first).
@@ -224,7 +277,7 @@ async def get_commit_timeline(user: str, repo: str, limit: int = 50) -> list[dic
       repo: repository name
       limit: max commits
     """
-    conn = _conn_for(user)
+    conn = _conn()
     return fetchall(
         conn,
         """
@@ -239,38 +292,64 @@ async def get_commit_timeline(user: str, repo: str, limit: int = 50) -> list[dic
     ) or []
 
 
-@mcp.tool()
+def _fts_query(query: str) -> str:
+    """Quote each term so user input is never parsed as FTS5 syntax."""
+    return " ".join('"' + t.replace('"', '""') + '"' for t in query.split())
+
+
+@_db_tool
 async def search_readmes(user: str, query: str, limit: int = 10) -> list[dict[str, Any]]:
     """
-    Search README text across all repos (simple LIKE search).
+    Search README text and descriptions across all repos (full-text, best match first).
 
     Args:
       user: GitHub username
       query: search string
       limit: max results
     """
-    conn = _conn_for(user)
-    q = f"%{query}%"
-    rows = fetchall(
-        conn,
-        """
-        SELECT repo, html_url, description
-        FROM repos
-        WHERE user_name=? AND (readme_text LIKE ? OR description LIKE ?)
-        ORDER BY repo
-        LIMIT ?
-        """,
-        (user, q, q, _safe_int(limit, 10)),
-    ) or []
+    conn = _conn()
+    rows = None
+    match = _fts_query(query or "")
+    if match and get_db_mode() == "sqlite":
+        try:
+            rows = fetchall(
+                conn,
+                """
+                SELECT r.repo, r.html_url, r.description
+                FROM readme_fts
+                JOIN repos r ON r.rowid = readme_fts.rowid
+                WHERE readme_fts MATCH ? AND r.user_name=?
+                ORDER BY readme_fts.rank
+                LIMIT ?
+                """,
+                (match, user, _safe_int(limit, 10)),
+            )
+        except Exception as e:
+            # No FTS5 index (e.g. SQLite built without it): fall back to LIKE.
+            LOGGER.warning("FTS search failed, falling back to LIKE: %s", e)
+
+    if rows is None:
+        q = f"%{query}%"
+        rows = fetchall(
+            conn,
+            """
+            SELECT repo, html_url, description
+            FROM repos
+            WHERE user_name=? AND (readme_text LIKE ? OR description LIKE ?)
+            ORDER BY repo
+            LIMIT ?
+            """,
+            (user, q, q, _safe_int(limit, 10)),
+        )
     # Normalize 'repo'/'name' for consistency
-    return [_normalize_repo_row(r) for r in rows]
+    return [_normalize_repo_row(r) for r in rows or []]
 
 
 # ============================================================
 # Multi-Repo Intelligence Tools
 # ============================================================
 
-@mcp.tool()
+@_db_tool
 async def query_repos_by_signals(
     user: str,
     tech_stack: Optional[str] = None,
@@ -289,7 +368,7 @@ async def query_repos_by_signals(
     - tech_stack uses LIKE matching against the detected tech stack string.
     - boolean flags map to 0/1 columns in repo_signals.
     """
-    conn = _conn_for(user)
+    conn = _conn()
 
     conditions = ["user_name=?"]
     params: list[Any] = [user]
@@ -352,10 +431,9 @@ async def query_repos_by_signals(
         (*params, _safe_int(limit, 20)),
     ) or []
 
-    # normalize key alignment
+    # normalize key alignment (rows are already fresh dicts; update in place)
     out: list[dict[str, Any]] = []
-    for r in rows:
-        rr = dict(r)
+    for rr in rows:
         rr["has_ci_config"] = bool(_safe_int(rr.get("has_ci_config", 0), 0))
         rr["has_tests"] = bool(_safe_int(rr.get("has_tests", 0), 0))
         rr["has_dockerfile"] = bool(_safe_int(rr.get("has_dockerfile", 0), 0))
@@ -370,12 +448,12 @@ async def query_repos_by_signals(
     return out
 
 
-@mcp.tool()
+@_db_tool
 async def aggregate_repo_metrics(user: str) -> dict[str, Any]:
     """
     Return high-level engineering metrics across all repos for a user.
     """
-    conn = _conn_for(user)
+    conn = _conn()
 
     def _count(sql: str, params: tuple[Any, ...]) -> int:
         row = fetchone(conn, sql, params) or {}
@@ -394,14 +472,14 @@ async def aggregate_repo_metrics(user: str) -> dict[str, Any]:
     }
 
 
-@mcp.tool()
+@_db_tool
 async def rank_repos_by_activity(user: str, limit: int = 10) -> list[dict[str, Any]]:
     """
     Rank repositories by commit activity (count of commits in the ingested window).
 
     Note: depends on how many commits you ingested per repo.
     """
-    conn = _conn_for(user)
+    conn = _conn()
     rows = fetchall(
         conn,
         """
@@ -1,7 +1,7 @@
 from datetime import datetime, timezone
 from typing import Optional
 
-from .common import connect, upsert, fetchone, LOGGER
+from .common import thread_connection, upsert, fetchone, LOGGER
 
 
 def upsert_user(
@@ -14,7 +14,7 @@ def upsert_user(
     Insert or update a GitHub user ingestion record.
     """
 
-    conn = connect()
+    conn = thread_connection()
 
     now = datetime.now(timezone.utc).isoformat()
 
@@ -30,13 +30,15 @@ def upsert_user(
 
     params = (user_name, now, repo_count, status, error)
 
-    upsert(conn, sql, params)
+    with conn:
+        upsert(conn, sql, params)
 
     LOGGER.info("User record updated: %s (status=%s)", user_name, status)
 
 
 def get_user(user_name: str):
-    conn = connect()
+    conn = thread_connection()
 
     sql = "SELECT * FROM users WHERE user_name = %s"
-    return fetchone(conn, sql, (user_name,))
\ No newline at end of file
+    with conn:
+        return fetchone(conn, sql, (user_name,))
\ No newline at end of file
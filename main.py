@@ -4,15 +4,17 @@ load_dotenv("secrets.env",override=False)
 
 import os
 import sys
+import json
+import hashlib
 import logging
 import asyncio
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from pydantic import BaseModel
 from concurrent.futures import ThreadPoolExecutor
 
-from github_mcp.common import connect, get_db_mode
+from github_mcp.common import connect, get_db_mode, refresh_db_mode, thread_connection
 from github_mcp.ingest import ingest
-from github_agent.agent import agent
+from github_agent.agent import agent, invalidate_tool_cache
 from github_mcp.user_service import upsert_user
 
 
@@ -111,6 +113,7 @@ def run_ingestion_job(user_name: str, token: str):
     try:
         # Force Postgres mode
         os.environ["DB_MODE"] = "postgres"
+        refresh_db_mode()
         os.environ["DATABASE_URL"] = os.getenv("DATABASE_URL")
         os.environ["GITHUB_TOKEN"] = token
 
@@ -153,6 +156,10 @@ def run_ingestion_job(user_name: str, token: str):
         except Exception as inner_e:
             LOGGER.error(f"Failed to update error status: {inner_e}")
 
+    finally:
+        # Tool results the agent cached for this user predate the new data.
+        invalidate_tool_cache(user_name)
+
 
 # -------------------------------------------------
 # Ingest Route (Non-Blocking)
@@ -177,7 +184,7 @@ async def ingest_user(data: IngestRequest):
 
         # Check if user already has data (optional - for optimization)
         try:
-            existing_user = get_user_status(data.user_name)
+            existing_user = _load_user_status(data.user_name)
             if existing_user and existing_user.get("status") == "completed" and existing_user.get("repo_count", 0) > 0:
                 LOGGER.info(f"User {data.user_name} already has {existing_user.get('repo_count')} repos. Starting fresh ingestion anyway.")
         except Exception:
@@ -205,64 +212,96 @@ async def ingest_user(data: IngestRequest):
 # -------------------------------------------------
 # User Status Route
 # -------------------------------------------------
-@app.get("/users/{user_name}")
-def get_user_status(user_name: str):
-    try:
-        conn = connect()
-
-        if os.environ.get("DB_MODE") == "postgres":
-            with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT * FROM users WHERE user_name = %s",
-                    (user_name,),
-                )
-                user = cur.fetchone()
-        else:
-            cur = conn.execute(
-                "SELECT * FROM users WHERE user_name = ?",
+def _load_user_status(user_name: str) -> dict:
+    conn = thread_connection()
+
+    # Same source as thread_connection(), so the branch matches the connection.
+    if get_db_mode() == "postgres":
+        # `with conn` ends the read transaction, so the reused connection
+        # never sits idle in a transaction (or stuck in an aborted one).
+        with conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT * FROM users WHERE user_name = %s",
                 (user_name,),
             )
             user = cur.fetchone()
-            user = dict(user) if user else None
+    else:
+        cur = conn.execute(
+            "SELECT * FROM users WHERE user_name = ?",
+            (user_name,),
+        )
+        user = cur.fetchone()
 
-        conn.close()
+    LOGGER.info(f"📊 Status fetched for {user_name}: {user}")
+    return user or {"status": "not_found"}
 
-        LOGGER.info(f"📊 Status fetched for {user_name}: {user}")
-        return user or {"status": "not_found"}
+
+@app.get("/users/{user_name}")
+def get_user_status(user_name: str, request: Request, response: Response):
+    try:
+        status = _load_user_status(user_name)
 
     except Exception as e:
         LOGGER.exception("Failed to fetch user status")
         raise HTTPException(status_code=500, detail=str(e))
 
+    # Status polls mostly see an unchanged record: answer a matching
+    # If-None-Match with an empty 304 instead of the JSON body.
+    etag = '"%s"' % hashlib.sha1(json.dumps(status, sort_keys=True, default=str).encode()).hexdigest()
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return status
+
 
 # -------------------------------------------------
 # Query Route (Instant)
 # -------------------------------------------------
+# Queries are stateless, so identical questions from the same user that
+# arrive while one is being answered share that run instead of starting
+# another agent run (planner + tools + synthesis) for the same answer.
+_INFLIGHT_QUERIES: dict[tuple[str, str], asyncio.Task] = {}
+
+
+async def _answer_query(user_name: str, question: str) -> dict:
+    initial_state = {
+        "question": question,
+        "username": user_name,  # AgentState expects "username", not "user_name"
+        "conversation_history": [],
+        "last_repo": None,
+        "last_repo_user": None,
+        "plan": None,
+        "tool_calls": None,
+        "tool_results": None,
+        "final_answer": None,
+    }
+
+    result = await agent.ainvoke(initial_state)
+
+    LOGGER.info(f"🤖 Answer generated for {user_name}")
+
+    return {
+        "answer": result.get("final_answer", "No response generated"),
+        "repo": result.get("last_repo"),
+    }
+
+
 @app.post("/query")
 async def query_user(data: QueryRequest):
     try:
         LOGGER.info(f"💬 Query for {data.user_name}: {data.question}")
 
-        initial_state = {
-            "question": data.question,
-            "username": data.user_name,  # AgentState expects "username", not "user_name"
-            "conversation_history": [],
-            "last_repo": None,
-            "last_repo_user": None,
-            "plan": None,
-            "tool_calls": None,
-            "tool_results": None,
-            "final_answer": None,
-        }
-
-        result = await agent.ainvoke(initial_state)
-
-        LOGGER.info(f"🤖 Answer generated for {data.user_name}")
+        key = (data.user_name, " ".join(data.question.split()))
+        task = _INFLIGHT_QUERIES.get(key)
+        if task is None:
+            task = asyncio.ensure_future(_answer_query(data.user_name, data.question))
+            _INFLIGHT_QUERIES[key] = task
+            task.add_done_callback(lambda _: _INFLIGHT_QUERIES.pop(key, None))
+        else:
+            LOGGER.info(f"Joining in-flight query for {data.user_name}")
 
-        return {
-            "answer": result.get("final_answer", "No response generated"),
-            "repo": result.get("last_repo"),
-        }
+        # Shielded: one client disconnecting must not cancel the shared run.
+        return await asyncio.shield(task)
 
     except Exception as e:
         LOGGER.exception("Query failed")
@@ -0,0 +1,20 @@
+"""
+Compact the local SQLite database (SQLITE_DB_PATH, DB_MODE=sqlite).
+
+Use this instead of running VACUUM by hand: it also rebuilds the README
+full-text index, which is keyed on rowids that VACUUM may renumber.
+"""
+import os
+
+from github_mcp.common import SQLITE_PATH, connect, get_db_mode, vacuum
+
+if get_db_mode() != "sqlite":
+    raise SystemExit(f"DB_MODE is {get_db_mode()!r}; vacuum only applies to SQLite")
+
+before = os.path.getsize(SQLITE_PATH) if SQLITE_PATH.exists() else 0
+
+conn = connect()
+vacuum(conn)
+conn.close()
+
+print(f"Vacuumed {SQLITE_PATH}: {before} -> {os.path.getsize(SQLITE_PATH)} bytes")